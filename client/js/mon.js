@@ -134,10 +134,10 @@
         loading = true;
       }
 
+      // No cache-busting suffix: the browser revalidates cached shards (ETag/Last-Modified)
       shard_path = shardsuffix(shard_date)
-      unique_suffix = "?now="+Date.now()+"&random="+Math.floor(Math.random()*1000000000)
-      debug("%s: loading shard %s as %s%s%s", name, shard_path, url, shard_path, unique_suffix)
-      $.get(url+shard_path+unique_suffix)
+      debug("%s: loading shard %s as %s%s", name, shard_path, url, shard_path)
+      $.get(url+shard_path)
         .always(function(data) {
           // First parameter is xhr on failure, data on success
 
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# Tests of lightlog. Run them from this directory as: test_lightlog.py [test_name ...]
+from __future__ import print_function
+import sys, imp, json
+from os.path import join, dirname, abspath
+from StringIO import StringIO
+sys.dont_write_bytecode = True
+lightlog = imp.load_source("lightlog", join(dirname(abspath(__file__)), "lightlog"))
+
+class FakeRequest(object):
+  # Request with a body, recording the response code
+  def __init__(self, body):
+    self.content = StringIO(body)
+    self.code = 200
+  def setHeader(self, name, value):
+    pass
+  def setResponseCode(self, code):
+    self.code = code
+
+def test_batch_timestamps():
+  # Invalid timestamps are rejected as a client error, and nothing is buffered
+  lightlog.store_prefix = "/nonexistent"
+  for ts in [ "inf", "-inf", "nan", 1e30, -1e30, float("inf"), "1e30", -1, "0001-01-01",
+              "1969-12-31T23:59:59Z", "2100-01-01", 4102444800 ]:
+    req = FakeRequest(json.dumps({ "thing": [ { "timestamp": ts, "temp": 20.5 } ] }))
+    resp = json.loads(lightlog.write_batch(req))
+    assert req.code == 400, "timestamp %r accepted: %s" % (ts, resp)
+    assert not lightlog.write_buffer, "timestamp %r buffered" % ts
+  for ts in [ 0, "1970-01-01", 1509530460, "2017-11-01T10:00:00Z", "2099-12-31T23:59:59.999Z" ]:
+    bufs = lightlog.parse_batch(json.dumps({ "thing": [ { "timestamp": ts, "temp": 20.5 } ] }))
+    assert len(bufs) == 1, "timestamp %r rejected" % ts
+
+tests = {
+  "batch_timestamps": test_batch_timestamps
+}
+
+if __name__ == "__main__":
+  names = sys.argv[1:] or sorted(tests.keys())
+  for name in names:
+    if not name in tests:
+      print("Unknown test: %s (available: %s)" % (name, ", ".join(sorted(tests.keys()))),
+            file=sys.stderr)
+      sys.exit(1)
+    tests[name]()
+    print("%s: OK" % name)
@@ -0,0 +1,62 @@
+## @file fakegpio.py
+#  Stand-in for the RPi.GPIO module, to run the switch controller off-hardware.
+#
+#  Only the functions used by rpi_switchctl.py are provided. Pin values are kept
+#  in memory and, if `state_file` is set, every change is appended to it as a
+#  line with the time of the change (seconds since the epoch), the pin and its
+#  new value.
+
+import time
+
+BOARD = 10
+BCM = 11
+OUT = 0
+IN = 1
+LOW = 0
+HIGH = 1
+
+## File where pin changes are logged, or None
+state_file = None
+
+## Current value of every pin set up
+_pins = {}
+
+
+## Sets the pin numbering scheme. Ignored.
+#
+#  @param mode BOARD or BCM
+def setmode(mode):
+  pass
+
+
+## Sets up a pin. Output pins start low.
+#
+#  @param pin       Pin number
+#  @param direction IN or OUT
+def setup(pin, direction):
+  _pins[pin] = LOW
+
+
+## Changes the value of a pin, and logs the change.
+#
+#  @param pin   Pin number
+#  @param value LOW or HIGH
+def output(pin, value):
+  _pins[pin] = value
+  if state_file:
+    with open(state_file, 'a') as fp:
+      fp.write('%.6f %d %d\n' % (time.time(), pin, value))
+
+
+## Reads the value of a pin.
+#
+#  @param pin Pin number
+#
+#  @return LOW or HIGH
+def input(pin):
+  return _pins[pin]
+
+
+## Releases all pins.
+def cleanup():
+  _pins.clear()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+## @file latency.py
+#  Measures the latency of the switch controller, off-hardware.
+#
+#  The switch controller is started with the GPIO stand-in, then the control
+#  file is written alternately with 1 and 0, like the Pi Heat daemon does. The
+#  latency is the time between writing the file and the change of the pin. Run
+#  it as:
+#
+#  ~~~{.sh}
+#  latency.py [--count=N] [--poll=SECONDS] [--socket] [--channels=N]
+#  ~~~
+#
+#  With `--poll` the controller polls the control file instead of using inotify.
+#  With `--socket` commands are sent through the controller socket instead, and
+#  the latency is the time until the confirmed state is received. With
+#  `--channels` a single controller drives several relays, all of them switched
+#  at every change: the latency is the time until the last one has changed.
+
+import sys, os, subprocess, tempfile, shutil, time, socket
+from getopt import getopt
+
+
+## Waits for new lines in the pin state file.
+#
+#  @param state_file State file written by the GPIO stand-in
+#  @param nlines     Number of lines already read
+#  @param count      Number of new lines to wait for
+#  @param timeout    Timeout in seconds
+#
+#  @return The time of the last change and the set of new values, or None on
+#          timeout
+def wait_changes(state_file, nlines, count, timeout):
+  deadline = time.time() + timeout
+  while time.time() < deadline:
+    with open(state_file) as fp:
+      lines = fp.read().splitlines()
+    if len(lines) >= nlines+count:
+      changes = [ l.split() for l in lines[nlines:nlines+count] ]
+      return max([ float(c[0]) for c in changes ]), set([ int(c[2]) for c in changes ])
+    time.sleep(0.001)
+  return None
+
+
+## Main function: entry point.
+#
+#  @param argv list of arguments
+def main(argv):
+  count = 10
+  extra = []
+  use_socket = False
+  nchan = 1
+  opt,_ = getopt(argv, '', [ 'count=', 'poll=', 'socket', 'channels=' ])
+  for k,v in opt:
+    if k == '--count':
+      count = int(v)
+    elif k == '--poll':
+      extra = [ '--poll=%s' % v ]
+    elif k == '--socket':
+      use_socket = True
+    elif k == '--channels':
+      nchan = int(v)
+
+  tmpdir = tempfile.mkdtemp(prefix='switchctl-latency-')
+  state_file = os.path.join(tmpdir, 'gpio')
+  ctlfiles = [ os.path.join(tmpdir, 'heat%d' % c) for c in range(nchan) ]
+  sock_paths = [ os.path.join(tmpdir, 'heat%d.sock' % c) for c in range(nchan) ]
+  for ctlfile in ctlfiles:
+    with open(ctlfile, 'w') as fp:
+      fp.write('0')
+  open(state_file, 'w').close()
+  ctl = subprocess.Popen([ sys.executable,
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                        'rpi_switchctl.py'),
+                           '--on-is-high', '--fake-gpio=%s' % state_file ] +
+                         [ '--channel=%s:%d:%s' % (ctlfiles[c], 16+c, sock_paths[c])
+                           for c in range(nchan) ] + extra)
+  latencies = []
+  socks = []
+  try:
+    # Initial setup of the pins
+    if wait_changes(state_file, 0, nchan, 10) is None:
+      print 'switch controller did not start'
+      return 1
+    timeout = 10 if not extra else 2*float(extra[0].split('=')[1]) + 1
+    if use_socket:
+      for sock_path in sock_paths:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(sock_path)
+        socks.append((sock, sock.makefile('r')))
+    for i in range(count):
+      status = (i+1) % 2
+      t0 = time.time()
+      if use_socket:
+        for sock,sockfp in socks:
+          sock.sendall('on\n' if status else 'off\n')
+          reply = sockfp.readline().strip()
+          if reply != ('on' if status else 'off'):
+            print 'switch did not confirm %d (%s)' % (status, reply)
+            return 1
+        t1 = time.time()
+      else:
+        for ctlfile in ctlfiles:
+          with open(ctlfile, 'w') as fp:
+            fp.write(str(status))
+      change = wait_changes(state_file, (i+1)*nchan, nchan, timeout)
+      if change is None or change[1] != set([ status ]):
+        print 'pins did not change to %d' % status
+        return 1
+      latencies.append((t1 if use_socket else change[0]) - t0)
+  finally:
+    for sock,_ in socks:
+      sock.close()
+    ctl.terminate()
+    ctl.wait()
+    shutil.rmtree(tmpdir)
+
+  print '%d changes of %d channels: latency min %.1f ms, avg %.1f ms, max %.1f ms' % \
+        (count, nchan, min(latencies)*1000, sum(latencies)/count*1000, max(latencies)*1000)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
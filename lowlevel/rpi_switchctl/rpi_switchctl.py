@@ -5,14 +5,169 @@
 #
 #  This program must be run as root, but it exposes a simple interface allowing
 #  non-root commands to interact with the switch.
+#
+#  Changes to the control file are waited for with inotify. Polling is used only
+#  if inotify is not available, or if requested. With `--fake-gpio` no hardware
+#  is needed: pin changes are logged to a file instead (see fakegpio.py).
+#
+#  With `--socket` the switch is also controlled through a UNIX socket. Clients
+#  send lines with `on`, `off` or `status`, and each command is answered with a
+#  line with the state of the relay (`on` or `off`) as read back from the pin
+#  after applying it. Commands received from the socket are written to the
+#  control file as well, which always holds the last requested state.
+#
+#  A single process can drive several relays: every `--channel=FILE:PIN[:SOCKET]`
+#  adds a relay with its own control file, pin and optional socket, on top of the
+#  one given with `--file`, `--pin` and `--socket`. Changes of all channels are
+#  waited for at once, and applied in one pass.
 
-import RPi.GPIO as GPIO
-import sys, signal, os
+import sys, signal, os, struct, ctypes, ctypes.util, socket, errno
+from select import select, error as select_error
 from getopt import getopt
-from time import sleep
+from time import time
 from pwd import getpwnam
 from grp import getgrnam
 
+## GPIO module: RPi.GPIO, or its stand-in
+GPIO = None
+
+
+## @class FileWatcher
+#  Waits for changes to a set of files with inotify.
+#
+#  The directories of the files are watched, so that files can be created, or
+#  replaced by renaming another file over them. Changes are reported when a file
+#  is closed after writing, never while it is being written.
+class FileWatcher(object):
+
+  ## File was closed after being opened for writing
+  IN_CLOSE_WRITE = 0x00000008
+  ## File was moved into the watched directory
+  IN_MOVED_TO = 0x00000080
+  ## Event queue overflowed: changes might have been missed
+  IN_Q_OVERFLOW = 0x00004000
+  ## Header of an inotify event: watch descriptor, mask, cookie, name length
+  event_header = struct.Struct('iIII')
+
+  ## Constructor.
+  #
+  #  @param paths List of files to watch
+  #
+  #  @exception OSError Raised if inotify is not available
+  def __init__(self, paths):
+    ## Watched files, by watch descriptor and file name
+    self._paths = {}
+    try:
+      libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+      init, add_watch = libc.inotify_init, libc.inotify_add_watch
+    except (OSError, AttributeError) as e:
+      raise OSError('inotify not supported: %s' % e)
+    self._fd = init()
+    if self._fd < 0:
+      raise OSError(ctypes.get_errno(), 'inotify_init failed')
+    for path in paths:
+      # Files in the same directory get the same watch descriptor
+      wd = add_watch(self._fd, os.path.dirname(os.path.abspath(path)),
+                     self.IN_CLOSE_WRITE|self.IN_MOVED_TO)
+      if wd < 0:
+        os.close(self._fd)
+        raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+      self._paths[(wd, os.path.basename(path))] = path
+
+
+  ## File descriptor to wait on: it is readable when there are new events.
+  def fileno(self):
+    return self._fd
+
+
+  ## Consumes pending events. Call it only when the descriptor is readable.
+  #
+  #  @return Set of the files that have changed
+  def changed(self):
+    buf = os.read(self._fd, 4096)
+    pos = 0
+    changed = set()
+    while pos < len(buf):
+      wd,mask,_,size = self.event_header.unpack_from(buf, pos)
+      pos = pos + self.event_header.size
+      name = buf[pos:pos+size].rstrip('\0')
+      pos = pos + size
+      if mask & self.IN_Q_OVERFLOW:
+        changed.update(self._paths.values())
+      elif (wd, name) in self._paths:
+        changed.add(self._paths[(wd, name)])
+    return changed
+
+
+## Reads the control file. An invalid or missing file is reset to 0.
+#
+#  @param ctlfile Control file
+#
+#  @return '0' or '1'
+def read_ctlfile(ctlfile):
+  try:
+    with open(ctlfile, 'r') as fp:
+      status = fp.read(1)
+    if status not in ['0', '1']:
+      raise ValueError('invalid value %s' % status)
+  except (IOError,ValueError) as e:
+    print 'error reading %s (%s), defaulting status to 0' % (ctlfile, str(e))
+    status = '0'
+    with open(ctlfile, 'w') as fp:
+      fp.write(status)
+  return status
+
+
+## Turns the relay on or off, if needed, then reads its state back from the pin.
+#
+#  @param pin        Pin number
+#  @param status_map GPIO value for 'on' and 'off'
+#  @param on         True to turn the relay on
+#
+#  @return True if the relay is on
+def set_switch(pin, status_map, on):
+  value = status_map['on' if on else 'off']
+  if GPIO.input(pin) != value:
+    print 'turning %s (pin %d => %s)' % ('on' if on else 'off', pin,
+                                         'high' if value == GPIO.HIGH else 'low')
+    GPIO.output(pin, value)
+  return GPIO.input(pin) == status_map['on']
+
+
+## Serves the commands received from a socket client.
+#
+#  @param client     Client socket
+#  @param buf        Data received so far and not yet processed
+#  @param channel    Channel controlled by the client
+#  @param status_map GPIO value for 'on' and 'off'
+#
+#  @return Data left to process, or None if the client is gone
+def serve_client(client, buf, channel, status_map):
+  try:
+    data = client.recv(4096)
+    if not data:
+      return None
+    buf = buf + data
+    while '\n' in buf:
+      cmd,buf = buf.split('\n', 1)
+      cmd = cmd.strip()
+      if cmd in ['on', 'off']:
+        with open(channel['ctlfile'], 'w') as fp:
+          fp.write('1' if cmd == 'on' else '0')
+        on = set_switch(channel['pin'], status_map, cmd == 'on')
+      elif cmd == 'status':
+        on = GPIO.input(channel['pin']) == status_map['on']
+      else:
+        client.sendall('error unknown command\n')
+        continue
+      client.sendall('on\n' if on else 'off\n')
+    if len(buf) > 4096:
+      return None
+    return buf
+  except (socket.error, IOError) as e:
+    print 'socket client error (%s)' % str(e)
+    return None
+
 
 ## Exits gracefully from the program by cleaning up GPIO. Callback on various
 #  quit signals.
@@ -20,7 +175,8 @@ from grp import getgrnam
 #  @param signum signal number
 #  @param frame frame
 def graceful_exit(signum, frame):
-  GPIO.cleanup()
+  if GPIO is not None:
+    GPIO.cleanup()
   sys.exit(0)
 
 
@@ -28,28 +184,26 @@ def graceful_exit(signum, frame):
 #
 #  @param argv list of arguments
 def main(argv):
+  global GPIO
 
   conf = {
     'ctlfile': None,
     'user': None,
     'group': None,
+    'mode': None,
     'pidfile': None,
-    'pin': None
-  }
-
-  status_map = {
-    'on': GPIO.LOW,
-    'off': GPIO.HIGH
-  }
-
-  gpio_status_name = {
-    GPIO.LOW: 'low',
-    GPIO.HIGH: 'high'
+    'pin': None,
+    'on_is_high': False,
+    'poll': None,
+    'fake_gpio': None,
+    'socket': None,
+    'channels': []
   }
 
   opt,_ = getopt(argv, '',
                  [ 'file=', 'user=', 'group=', 'mode=', 'pidfile=',
-                   'pin=', 'on-is-high' ])
+                   'pin=', 'on-is-high', 'poll=', 'fake-gpio=', 'socket=',
+                   'channel=' ])
 
   for k,v in opt:
     if k == '--file':
@@ -65,19 +219,51 @@ def main(argv):
     elif k == '--pin':
       conf['pin'] = int(v)
     elif k == '--on-is-high':
-      status_map['on'] = GPIO.HIGH
-      status_map['off'] = GPIO.LOW
+      conf['on_is_high'] = True
+    elif k == '--poll':
+      conf['poll'] = float(v)
+    elif k == '--fake-gpio':
+      conf['fake_gpio'] = v
+    elif k == '--socket':
+      conf['socket'] = v
+    elif k == '--channel':
+      v = v.split(':', 2)
+      conf['channels'].append({ 'ctlfile': v[0],
+                                'pin': int(v[1]),
+                                'socket': v[2] if len(v) > 2 else None })
+
+  # Channel given with --file, --pin and --socket comes first
+  channels = conf['channels']
+  if conf['ctlfile'] is not None:
+    channels.insert(0, { 'ctlfile': conf['ctlfile'],
+                         'pin': conf['pin'],
+                         'socket': conf['socket'] })
 
-  # Permissions for that file
+  if conf['fake_gpio'] is not None:
+    import fakegpio as GPIO
+    GPIO.state_file = conf['fake_gpio']
+  else:
+    import RPi.GPIO as GPIO
+
+  status_map = {
+    'on': GPIO.LOW,
+    'off': GPIO.HIGH
+  }
+  if conf['on_is_high']:
+    status_map['on'] = GPIO.HIGH
+    status_map['off'] = GPIO.LOW
+
+  # Permissions for control files
   uid = -1
   gid = -1
   if conf['user'] is not None:
     uid = getpwnam( conf['user'] ).pw_uid
   if conf['group'] is not None:
     gid = getgrnam( conf['group'] ).gr_gid
-  os.chown(conf['ctlfile'], uid, gid)
-  if conf['mode'] is not None:
-    os.chmod(conf['ctlfile'], conf['mode'])
+  for ch in channels:
+    os.chown(ch['ctlfile'], uid, gid)
+    if conf['mode'] is not None:
+      os.chmod(ch['ctlfile'], conf['mode'])
 
   # Process ID to a file
   if conf['pidfile']:
@@ -86,54 +272,82 @@ def main(argv):
 
   # Using GPIO.BOARD numbering scheme, i.e.: number of PINs as on the board
   GPIO.setmode(GPIO.BOARD)
-  GPIO.setup(conf['pin'], GPIO.OUT)
-  GPIO.output(conf['pin'], status_map['off'])
+  for ch in channels:
+    GPIO.setup(ch['pin'], GPIO.OUT)
+    GPIO.output(ch['pin'], status_map['off'])
 
-  pin_status = status_map['off']
+  # Sockets with the same permissions as control files (stale ones are removed)
+  servers = {}
+  clients = {}
+  for ch in channels:
+    if ch['socket'] is None:
+      continue
+    try:
+      os.remove(ch['socket'])
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        raise
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(ch['socket'])
+    os.chown(ch['socket'], uid, gid)
+    if conf['mode'] is not None:
+      os.chmod(ch['socket'], conf['mode'])
+    server.listen(5)
+    servers[server] = ch
+
+  # Watching starts before the first read, so that no change is missed
+  watcher = None
+  if conf['poll'] is None:
+    try:
+      watcher = FileWatcher([ ch['ctlfile'] for ch in channels ])
+    except OSError as e:
+      print 'cannot watch control files (%s), polling every 5 s' % str(e)
+      conf['poll'] = 5
 
+  changed = channels
   while True:
 
-    sleep(5)
+    # Changed control files are applied in one pass
+    for ch in changed:
+      set_switch(ch['pin'], status_map, read_ctlfile(ch['ctlfile']) == '1')
+    if changed is channels:
+      # All files were read: the next poll is due one period later
+      next_poll = time() + (conf['poll'] or 0)
 
+    fds = clients.keys() + servers.keys()
+    if watcher:
+      fds.append(watcher)
+    timeout = None
+    if not watcher:
+      timeout = max(next_poll-time(), 0)
     try:
-      with open(conf['ctlfile'], 'r') as fp:
-        newstatus = fp.read(1)
-      if newstatus not in ['0', '1']:
-        raise ValueError('invalid value %s' % newstatus)
-    except (IOError,ValueError) as e:
-      print 'error reading %s (%s), defaulting status to 0' % \
-            (conf["ctlfile"], str(e))
-      newstatus = '0'
-      with open(conf['ctlfile'], 'w') as fp:
-        fp.write(newstatus)
-
-    if newstatus == '1':
-      if pin_status == status_map['off']:
-        pin_status = status_map['on']
-        print 'turning on (pin %d => %s)' % (conf['pin'], gpio_status_name[pin_status])
-        GPIO.output(conf['pin'], pin_status)
-    else:
-      if pin_status == status_map['on']:
-        pin_status = status_map['off']
-        print 'turning off (pin %d => %s)' % (conf['pin'], gpio_status_name[pin_status])
-        GPIO.output(conf['pin'], pin_status)
-
-    # Interactive
-    # print 'cmd> ',
-    # cmd = sys.stdin.readline().strip()
-    # print '\r',
-
-    # if cmd == 'quit' or cmd == 'exit':
-    #   print 'exiting'
-    #   break
-    # elif cmd == 'on':
-    #   print 'turning on'
-    #   GPIO.output(conf['pin'], status_map['on'])
-    # elif cmd == 'off':
-    #   print 'turning off'
-    #   GPIO.output(conf['pin'], status_map['off'])
-    # elif cmd != '':
-    #   print 'not understood'
+      ready,_,_ = select(fds, [], [], timeout)
+    except select_error as e:
+      if e.args[0] == errno.EINTR:
+        ready = []
+      else:
+        raise
+
+    changed = []
+    if watcher:
+      if watcher in ready:
+        paths = watcher.changed()
+        changed = [ ch for ch in channels if ch['ctlfile'] in paths ]
+    elif time() >= next_poll:
+      changed = channels
+
+    for fd in ready:
+      if fd in servers:
+        client,_ = fd.accept()
+        clients[client] = (servers[fd], '')
+      elif fd in clients:
+        ch,buf = clients[fd]
+        buf = serve_client(fd, buf, ch, status_map)
+        if buf is None:
+          fd.close()
+          del clients[fd]
+        else:
+          clients[fd] = (ch, buf)
 
   GPIO.cleanup()
 
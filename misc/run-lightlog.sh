@@ -37,8 +37,10 @@ rsync -av \
       "$REMOTE_STORE" \
       /var/tmp/lightlog/ || true
 
+# Upload changed files, then delete removed ones (missing from the store) from the remote store
+DUMP_RSYNC='rsync -av --rsh="sshpass -p `cat ~/.lightlogcreds|cut -d: -f2-` ssh -oUserKnownHostsFile=/dev/null -oStrictHostKeyChecking=no -l `cat ~/.lightlogcreds|cut -d: -f1`"'
 screen -dmS lightlog \
-            lightlog --after-dump-cmd 'rsync -av --rsh="sshpass -p `cat ~/.lightlogcreds|cut -d: -f2-` ssh -oUserKnownHostsFile=/dev/null -oStrictHostKeyChecking=no -l `cat ~/.lightlogcreds|cut -d: -f1`" {store_prefix}/ '"$REMOTE_STORE" \
+            lightlog --after-dump-cmd "$DUMP_RSYNC --files-from={changed} {store_prefix}/ $REMOTE_STORE && $DUMP_RSYNC --delete-missing-args --files-from={removed} {store_prefix}/ $REMOTE_STORE" \
                      --dump-every 60 \
                      --store /var/tmp/lightlog \
                      --host 0.0.0.0
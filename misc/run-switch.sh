@@ -7,6 +7,7 @@ PID=$(cat $PIDFILE 2> /dev/null || echo 123456789)
 kill -0 $PID && false
 nohup $DEST/lowlevel/rpi_switchctl/rpi_switchctl.py \
   --file=/tmp/heat \
+  --socket=/tmp/heat.sock \
   --user=piheat \
   --group=piheat \
   --mode=0600 \
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+## @file bench.py
+#  Micro-benchmarks for the Pi Heat daemon.
+#
+#  No network access is performed: dweet.io responses are synthesized locally. Run it from the test
+#  environment (`source env-test.sh`) as:
+#
+#  ~~~{.sh}
+#  bench.py [benchmark_name ...]
+#  ~~~
+
+import sys, os, json, logging, tempfile, timeit, random, calendar, datetime
+import piheat
+from piheat import PiHeat
+from piheat.timestamp import TimeStamp
+from piheat.nonceledger import NonceLedger
+from piheat.program import WeekTable
+
+
+## Fake response object returned in place of HTTP requests. Like the real one, it parses its text
+#  again at each `json()` call.
+class FakeResponse(object):
+  def __init__(self, text, status_code=200):
+    self.text = text
+    self.status_code = status_code
+  def json(self):
+    return json.loads(self.text)
+
+
+## Current fake response served by `fake_request`.
+fake_response = FakeResponse('{"with":[]}')
+
+def fake_request(*args, **kwargs):
+  return fake_response
+
+
+## Creates a configured PiHeat instance with no network access.
+def make_piheat():
+  fd,conffile = tempfile.mkstemp(prefix='piheat-bench-', suffix='.json')
+  with os.fdopen(fd, 'w') as fp:
+    fp.write(json.dumps({ 'thingid': 'bench',
+                          'thingname': 'bench',
+                          'msg_expiry_s': 300,
+                          'cmd_expiry_s': 7200,
+                          'get_commands_every_s': 30,
+                          'send_status_every_s': 60,
+                          'password': 'bench',
+                          'switch_file': os.devnull }))
+  pih = PiHeat('piheat-bench', os.devnull, conffile)
+  pih._dweet._session.request = fake_request
+  assert pih.read_conf(), 'cannot read configuration'
+  pih._conffile = os.devnull
+  os.remove(conffile)
+  return pih
+
+
+## Creates a dweet.io page of `n` valid, non-command encrypted dweets, newest first. The whole
+#  page must be scanned to find out there is no command in it.
+def make_dweets_page(pih, n):
+  now = TimeStamp().get_timestamp_usec_utc()
+  items = []
+  for i in range(n):
+    created = str(TimeStamp(now-i))
+    items.append({ 'thing': 'bench',
+                   'created': created,
+                   'content': pih.encrypt_msg({ 'type': 'status', 'timestamp': created }) })
+  return json.dumps({ 'this': 'succeeded', 'with': items })
+
+
+## Reference implementation of the command scan before parsing the page once.
+def legacy_get_latest_command(self):
+  r = fake_request('GET', 'https://dweet.io/get/dweets/for/%s' % self._thingid,
+                   timeout=self._requests_timeout)
+  for idx,item in enumerate( r.json()['with'] ):
+    now_ts = TimeStamp()
+    msg_ts = TimeStamp.from_iso_str( item['created'] )
+    if (now_ts-msg_ts).total_seconds() <= self._cmd_expiry_s:
+      nonce = item['content']['nonce']
+      nonce_is_unique = True
+      for ridx, ritem in reversed( list(enumerate(r.json()['with']))[idx+1:] ):
+        if 'nonce' in ritem['content'] and nonce == ritem['content']['nonce']:
+          nonce_is_unique = False
+          break
+      if nonce_is_unique:
+        msg = self.decrypt_msg(item['content'])
+    else:
+      break
+  return True
+
+
+## Runs `get_latest_command` with an empty nonce ledger and decryption cache.
+def fresh_get_latest_command(pih):
+  pih._nonces = NonceLedger(None)
+  pih._decrypt_cache.clear()
+  return pih.get_latest_command()
+
+
+## Benchmarks the dweets page scan of `get_latest_command`. The current implementation is measured
+#  both on a fresh start and on subsequent polls, where all nonces are already in the ledger.
+def bench_commands():
+  global fake_response
+  pih = make_piheat()
+  print 'get_latest_command: scan of a full page of dweets'
+  print '%8s %14s %14s %8s %14s' % ('dweets', 'legacy [ms]', 'current [ms]', 'speedup', 'next poll [ms]')
+  for n in [ 100, 500, 1000, 2000 ]:
+    fake_response = FakeResponse(make_dweets_page(pih, n))
+    reps = 3
+    t_old = min(timeit.repeat(lambda: legacy_get_latest_command(pih), number=1, repeat=reps))
+    t_new = min(timeit.repeat(lambda: fresh_get_latest_command(pih), number=1, repeat=reps))
+    t_next = min(timeit.repeat(lambda: pih.get_latest_command(), number=1, repeat=reps))
+    print '%8d %14.2f %14.2f %7.1fx %14.2f' % (n, t_old*1000, t_new*1000, t_old/t_new, t_next*1000)
+
+
+## Creates a random program of `n` intervals.
+def make_program(n):
+  rnd = random.Random(n)
+  hm = lambda: rnd.randint(0, 23)*100 + rnd.randint(0, 59)
+  return [ { 'begin': hm(), 'end': hm(), 'temp': rnd.randint(150, 220)/10. } for i in range(n) ]
+
+
+## Reference implementation of the program evaluation before compiling programs.
+def legacy_evaluate_program(program, hm):
+  logging.debug('Programs are set: ' + json.dumps(program))
+  temps = [p.get('temp', 9999) for p in program if PiHeat.tminc(hm, p['begin'], p['end'])] + [-9999]
+  return len(temps) > 1, temps[0]
+
+
+## Benchmarks program evaluation: current target temperature and next transition. Programs are
+#  compiled into a week-long table.
+def bench_program():
+  print 'program evaluation: lookup of target temperature and next transition'
+  print '%10s %14s %14s %14s %8s' % ('intervals', 'compile [ms]', 'legacy [us]', 'current [us]',
+                                     'speedup')
+  for n in [ 10, 100, 1000, 5000 ]:
+    program = make_program(n)
+    reps = 2000
+    entries = [ (p['begin'], p['end'], p['temp'], None) for p in program ]
+    t_comp = min(timeit.repeat(lambda: WeekTable(entries, [], 0), number=1, repeat=3))
+    table = WeekTable(entries, [], 0)
+    t_old = min(timeit.repeat(lambda: legacy_evaluate_program(program, 1234),
+                              number=reps//n+1, repeat=3)) / (reps//n+1)
+    t_new = min(timeit.repeat(lambda: (table.lookup(754), table.next_change(754)),
+                              number=reps, repeat=3)) / reps
+    print '%10d %14.2f %14.2f %14.2f %7.0fx' % (n, t_comp*1000, t_old*1000000, t_new*1000000,
+                                               t_old/t_new)
+
+
+## Reference implementation of TimeStamp before storing integer microseconds.
+class LegacyTimeStamp:
+  def __init__(self, ts_utc=None):
+    if ts_utc is None:
+      self._dt_utc = datetime.datetime.utcnow()
+    else:
+      self._dt_utc = datetime.datetime.utcfromtimestamp(ts_utc)
+  @classmethod
+  def from_iso_str(cls, isodate):
+    iso_to_dt = datetime.datetime.strptime(isodate, TimeStamp.format['ISO_FULL'])
+    return cls( calendar.timegm( iso_to_dt.utctimetuple() ) + iso_to_dt.microsecond * 0.000001 )
+  def get_timestamp_usec_utc(self):
+    return calendar.timegm( self._dt_utc.utctimetuple() ) + self._dt_utc.microsecond * 0.000001
+  def __str__(self):
+    return self._dt_utc.strftime(TimeStamp.format['ISO_FULL'])
+  def __sub__(self, other):
+    return datetime.timedelta(seconds=self.get_timestamp_usec_utc()-other.get_timestamp_usec_utc())
+
+
+## Benchmarks TimeStamp parsing, formatting and subtraction.
+def bench_timestamp():
+  print 'TimeStamp: per operation cost'
+  print '%24s %14s %14s %8s' % ('operation', 'legacy [us]', 'current [us]', 'speedup')
+  iso = '2014-07-30T21:06:15.600Z'
+  ops = [
+    ( 'from_iso_str', lambda cls: cls.from_iso_str(iso) ),
+    ( 'now', lambda cls: cls() ),
+    ( 'str', lambda cls, ts={}: str(ts.setdefault(cls, cls(1406754375.6))) ),
+    ( 'now - from_iso_str', lambda cls: (cls()-cls.from_iso_str(iso)).total_seconds() ),
+  ]
+  reps = 20000
+  for name,op in ops:
+    t_old = min(timeit.repeat(lambda: op(LegacyTimeStamp), number=reps, repeat=3)) / reps
+    t_new = min(timeit.repeat(lambda: op(TimeStamp), number=reps, repeat=3)) / reps
+    print '%24s %14.2f %14.2f %7.1fx' % (name, t_old*1000000, t_new*1000000, t_old/t_new)
+  isos = [ str(TimeStamp(1406754375.6+i)) for i in range(500) ]
+  reps = 20
+  t_old = min(timeit.repeat(lambda: [ LegacyTimeStamp.from_iso_str(d) for d in isos ],
+                            number=reps, repeat=3)) / reps / len(isos)
+  t_new = min(timeit.repeat(lambda: TimeStamp.from_iso_str_batch(isos),
+                            number=reps, repeat=3)) / reps / len(isos)
+  print '%24s %14.2f %14.2f %7.1fx' % ('from_iso_str_batch (500)', t_old*1000000, t_new*1000000,
+                                      t_old/t_new)
+
+
+## Available benchmarks
+benchmarks = {
+  'commands': bench_commands,
+  'program': bench_program,
+  'timestamp': bench_timestamp
+}
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.CRITICAL)
+  names = sys.argv[1:] or sorted(benchmarks.keys())
+  for name in names:
+    if not name in benchmarks:
+      sys.stderr.write('Unknown benchmark: %s (available: %s)\n' %
+                       (name, ', '.join(sorted(benchmarks.keys()))))
+      sys.exit(1)
+    benchmarks[name]()
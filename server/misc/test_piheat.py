@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+## @file test_piheat.py
+#  Tests of the Pi Heat daemon.
+#
+#  No network access is performed: dweet.io pages are synthesized locally. Run it from the test
+#  environment (`source env-test.sh`) as:
+#
+#  ~~~{.sh}
+#  test_piheat.py [test_name ...]
+#  ~~~
+
+import sys, logging
+from piheat.timestamp import TimeStamp
+from bench import make_piheat
+
+
+## Creates a dweet.io page of encrypted commands, newest first.
+#
+#  @param pih      PiHeat instance encrypting the messages
+#  @param programs List of (command id, program) tuples, newest first
+def make_commands_page(pih, programs):
+  now = TimeStamp().usec
+  items = []
+  for i,(cmd_id,program) in enumerate(programs):
+    created = str(TimeStamp.from_usec(now - i*1000000))
+    items.append({ 'thing': 'bench',
+                   'created': created,
+                   'content': pih.encrypt_msg({ 'type': 'command',
+                                                'id': cmd_id,
+                                                'timestamp': created,
+                                                'program': program,
+                                                'override_program': None,
+                                                'holidays': [] }) })
+  return items
+
+
+## An invalid program does not prevent older valid commands on the same page from being applied,
+#  and it is not processed again at the next poll.
+def test_invalid_program():
+  valid = [ { 'begin': 700, 'end': 2200, 'temp': 20.5 } ]
+  for invalid in [ [ { 'begin': 2500, 'end': 2200, 'temp': 20.5 } ],
+                   [ { 'begin': 700, 'end': 2200, 'temp': 20.5, 'days': [ 7 ] } ] ]:
+    pih = make_piheat()
+    items = make_commands_page(pih, [ ('invalid', invalid), ('valid', valid) ])
+    assert pih.process_dweets(items), 'page with an invalid program rejected'
+    assert pih._lastcmd_id == 'valid', 'valid command not applied: %s' % pih._lastcmd_id
+    assert pih._program == valid, 'valid program not set'
+    pih._lastcmd_id = None
+    assert pih.process_dweets(items), 'page with an invalid program rejected at the next poll'
+    assert pih._lastcmd_id is None, 'messages processed again'
+
+
+## Available tests
+tests = {
+  'invalid_program': test_invalid_program
+}
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.CRITICAL)
+  names = sys.argv[1:] or sorted(tests.keys())
+  for name in names:
+    if not name in tests:
+      sys.stderr.write('Unknown test: %s (available: %s)\n' %
+                       (name, ', '.join(sorted(tests.keys()))))
+      sys.exit(1)
+    tests[name]()
+    print '%s: OK' % name
@@ -48,8 +48,9 @@ class Daemon(object):
     self.logctl.addHandler(stderr_handler)
 
     syslog_handler = self._get_syslog_handler()
-    syslog_handler.setFormatter(logctl_formatter)
-    self.logctl.addHandler(syslog_handler)
+    if syslog_handler:
+      syslog_handler.setFormatter(logctl_formatter)
+      self.logctl.addHandler(syslog_handler)
 
     self.logctl.setLevel(logging.DEBUG)
 
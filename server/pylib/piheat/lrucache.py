@@ -0,0 +1,74 @@
+## @file lrucache.py
+#  Contains a class definition for a small LRU cache.
+
+from collections import OrderedDict
+
+## @class LRUCache
+#  Least recently used cache with a maximum number of entries.
+#
+#  Hits and misses are counted, so that the effectiveness of the cache can be checked.
+class LRUCache(object):
+
+  ## Marker for missing entries, to be used as default value when `None` can be cached
+  missing = object()
+
+  ## Constructor.
+  #
+  #  @param size Maximum number of entries
+  def __init__(self, size):
+    ## Maximum number of entries
+    self.size = size
+    ## Number of lookups that found an entry
+    self.hits = 0
+    ## Number of lookups that did not find an entry
+    self.misses = 0
+    ## Entries, from the least to the most recently used
+    self._entries = OrderedDict()
+
+
+  ## Number of entries in the cache.
+  def __len__(self):
+    return len(self._entries)
+
+
+  ## Checks if a key is in the cache, without affecting counters and order.
+  def __contains__(self, key):
+    return key in self._entries
+
+
+  ## Gets an entry, and marks it as the most recently used.
+  #
+  #  @param key     Key of the entry
+  #  @param default Value returned if the key is not found
+  #
+  #  @return The cached value, or `default`
+  def get(self, key, default=None):
+    try:
+      value = self._entries.pop(key)
+    except KeyError:
+      self.misses = self.misses + 1
+      return default
+    self._entries[key] = value
+    self.hits = self.hits + 1
+    return value
+
+
+  ## Adds or replaces an entry, evicting the least recently used one if the cache is full.
+  #
+  #  @param key   Key of the entry
+  #  @param value Value to cache
+  def put(self, key, value):
+    self._entries.pop(key, None)
+    self._entries[key] = value
+    while len(self._entries) > self.size:
+      self._entries.popitem(last=False)
+
+
+  ## Removes all entries. Counters are retained.
+  def clear(self):
+    self._entries.clear()
+
+
+  ## String with current cache statistics.
+  def __str__(self):
+    return '%d hits, %d misses, %d/%d entries' % (self.hits, self.misses, len(self), self.size)
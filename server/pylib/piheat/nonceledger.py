@@ -0,0 +1,174 @@
+## @file nonceledger.py
+#  Contains a class definition for keeping track of already seen nonces.
+
+import os, mmap, struct, heapq, logging
+from Crypto.Hash import SHA256
+
+## @class NonceLedger
+#  Ledger of nonces already seen, surviving restarts.
+#
+#  Each nonce is stored along with its expiration time (integer microseconds since the epoch, UTC).
+#  Lookups are performed on an in-memory dictionary, and a heap ordered by expiration time allows to
+#  evict outdated nonces cheaply: since messages older than the command expiry are never considered,
+#  memory is bounded by the number of messages received within that window.
+#
+#  Nonces are also appended to a memory-mapped file made of fixed-size records. When the file is
+#  full it is compacted by dropping expired records, and grown if still too crowded. If the file
+#  cannot be used the ledger keeps working in memory only.
+class NonceLedger(object):
+
+  ## Format of a record on file: expiry (usec) and a nonce key
+  record = struct.Struct('<q24s')
+
+  ## Constructor.
+  #
+  #  @param path     Full path to the ledger file, or None to keep the ledger in memory only
+  #  @param capacity Initial number of records in the ledger file
+  def __init__(self, path, capacity=1024):
+    ## Full path to the ledger file
+    self._path = path
+    ## Number of records the ledger file can hold
+    self._capacity = capacity
+    ## Expiry of each nonce key (usec)
+    self._expiry = {}
+    ## Heap of `(expiry, key)` tuples, for eviction
+    self._heap = []
+    ## Number of records written to the ledger file
+    self._count = 0
+    ## Ledger file object
+    self._fp = None
+    ## Memory map of the ledger file
+    self._mm = None
+
+
+  ## Number of nonces currently in the ledger.
+  def __len__(self):
+    return len(self._expiry)
+
+
+  ## Converts a nonce to a fixed-size key. Regular nonces (16 bytes encoded in base64) are used as
+  #  they are, anything longer is hashed.
+  #
+  #  @param nonce A nonce string
+  #
+  #  @return A 24 bytes string
+  @staticmethod
+  def _key(nonce):
+    nonce = str(nonce)
+    if len(nonce) > 24:
+      hashfunc = SHA256.new()
+      hashfunc.update(nonce)
+      return hashfunc.digest()[:24]
+    return nonce.ljust(24, '\0')
+
+
+  ## Opens the ledger file, creating it if it does not exist, and loads non-expired nonces.
+  #
+  #  @param now_usec Current time (usec): nonces expired before it are not loaded
+  #
+  #  @return True on success, False if the ledger could not be opened (memory only ledger)
+  def load(self, now_usec):
+    if self._path is None:
+      return False
+    self.close()
+    try:
+      if not os.path.isfile(self._path):
+        with open(self._path, 'wb') as fp:
+          fp.truncate(self._capacity*self.record.size)
+      self._fp = open(self._path, 'r+b')
+      size = os.fstat(self._fp.fileno()).st_size
+      if size < self.record.size:
+        self._fp.truncate(self._capacity*self.record.size)
+        size = self._capacity*self.record.size
+      self._capacity = size // self.record.size
+      self._mm = mmap.mmap(self._fp.fileno(), self._capacity*self.record.size)
+    except (IOError, OSError, mmap.error) as e:
+      logging.error('cannot open nonce ledger %s, keeping it in memory only: %s' % (self._path, e))
+      self.close()
+      return False
+
+    # Records are appended: the first empty record marks the end
+    self._count = 0
+    while self._count < self._capacity:
+      expiry,key = self.record.unpack_from(self._mm, self._count*self.record.size)
+      if expiry == 0:
+        break
+      self._count = self._count + 1
+      if expiry > now_usec and expiry > self._expiry.get(key, 0):
+        self._expiry[key] = expiry
+        heapq.heappush(self._heap, (expiry, key))
+    logging.debug('nonce ledger %s loaded: %d valid nonces out of %d records' %
+                  (self._path, len(self._expiry), self._count))
+    return True
+
+
+  ## Closes the ledger file. In-memory nonces are retained.
+  def close(self):
+    if self._mm is not None:
+      self._mm.close()
+      self._mm = None
+    if self._fp is not None:
+      self._fp.close()
+      self._fp = None
+
+
+  ## Gets the expiry of a nonce.
+  #
+  #  @param nonce A nonce string
+  #
+  #  @return Expiry of the nonce (usec), or None if the nonce was never seen
+  def get(self, nonce):
+    return self._expiry.get(self._key(nonce), None)
+
+
+  ## Adds a nonce to the ledger, and appends it to the ledger file.
+  #
+  #  @param nonce       A nonce string
+  #  @param expiry_usec Expiration time of the nonce (usec)
+  def add(self, nonce, expiry_usec):
+    key = self._key(nonce)
+    if self._mm is not None:
+      try:
+        if self._count >= self._capacity:
+          self._compact()
+        self.record.pack_into(self._mm, self._count*self.record.size, expiry_usec, key)
+        self._mm.flush()
+        self._count = self._count + 1
+      except (IOError, OSError, mmap.error) as e:
+        logging.error('cannot write to nonce ledger %s, keeping it in memory only: %s' %
+                      (self._path, e))
+        self.close()
+    self._expiry[key] = expiry_usec
+    heapq.heappush(self._heap, (expiry_usec, key))
+
+
+  ## Evicts expired nonces, in order of expiration time.
+  #
+  #  @param now_usec Current time (usec)
+  def evict(self, now_usec):
+    while self._heap and self._heap[0][0] <= now_usec:
+      expiry,key = heapq.heappop(self._heap)
+      if self._expiry.get(key, None) == expiry:
+        del self._expiry[key]
+
+
+  ## Rewrites the ledger file with valid nonces only, growing it if more than half full.
+  def _compact(self):
+    capacity = self._capacity
+    while len(self._expiry)+1 >= capacity // 2:
+      capacity = capacity * 2
+    logging.debug('compacting nonce ledger %s: %d valid nonces, capacity %d' %
+                  (self._path, len(self._expiry), capacity))
+    buf = bytearray(capacity*self.record.size)
+    count = 0
+    for key,expiry in self._expiry.iteritems():
+      self.record.pack_into(buf, count*self.record.size, expiry, key)
+      count = count + 1
+    with open(self._path+'.0', 'wb') as fp:
+      fp.write(buf)
+    self.close()
+    os.rename(self._path+'.0', self._path)  # atomic
+    self._fp = open(self._path, 'r+b')
+    self._mm = mmap.mmap(self._fp.fileno(), capacity*self.record.size)
+    self._capacity = capacity
+    self._count = count
@@ -0,0 +1,248 @@
+## @file program.py
+#  Contains a class definition for compiled heating programs.
+
+import bisect, heapq, calendar, datetime
+from array import array
+
+
+## Divides a span of minutes into contiguous segments with constant value.
+#
+#  Where intervals overlap, the one with the lowest priority number wins.
+#
+#  @param intervals List of `(begin, end, priority, value)` tuples, in minutes, end excluded
+#  @param span      Length of the span in minutes
+#
+#  @return A tuple with the list of start minutes of each segment and the list of their values
+#          (None where no interval is active)
+def sweep(intervals, span):
+  intervals = sorted(intervals)
+  bounds = sorted(set([ 0 ] + [ i[0] for i in intervals ] + [ i[1] for i in intervals ]))
+  starts = []
+  values = []
+  active = []
+  idx = 0
+  for b in bounds:
+    if b >= span:
+      break
+    while idx < len(intervals) and intervals[idx][0] <= b:
+      heapq.heappush(active, (intervals[idx][2], intervals[idx][1], intervals[idx][3]))
+      idx = idx + 1
+    while active and active[0][1] <= b:
+      heapq.heappop(active)
+    value = active[0][2] if active else None
+    if not values or values[-1] != value:
+      starts.append(b)
+      values.append(value)
+  return starts, values
+
+
+## @class ProgramTable
+#  Heating program compiled into a sorted table of minute-of-day intervals.
+#
+#  A program is a list of entries with a `begin` and an `end` time in the HHMM format, and an
+#  associated value. Intervals wrapping around midnight are split in two, and entries with negative
+#  `begin` or `end` last the whole day. When entries overlap, the first one in the list wins.
+#
+#  The day is divided into contiguous segments with constant value, so that the value at a given
+#  minute and the next transition are found by bisection.
+class ProgramTable(object):
+
+  ## Minutes in a day
+  day_min = 1440
+
+  ## Constructor.
+  #
+  #  @param entries List of `(begin, end, value)` tuples, with `begin` and `end` in HHMM format.
+  #                 Values must not be None
+  #
+  #  @exception TypeError  Raised if `begin` or `end` are not numbers
+  #  @exception ValueError Raised if `begin` or `end` are not valid times
+  def __init__(self, entries):
+    intervals = []
+    for prio,(beg,end,value) in enumerate(entries):
+      if beg < 0 or end < 0:
+        intervals.append( (0, self.day_min, prio, value) )
+        continue
+      beg = self.hm_to_min(beg)
+      end = self.hm_to_min(end)
+      if beg < end:
+        intervals.append( (beg, end, prio, value) )
+      else:
+        intervals.append( (beg, self.day_min, prio, value) )
+        if end > 0:
+          intervals.append( (0, end, prio, value) )
+    ## Start minute of each segment, and value of each segment (None if no entry is active)
+    self.starts, self.values = sweep(intervals, self.day_min)
+
+
+  ## Converts a HHMM time to minutes since midnight.
+  #
+  #  @param hm Time in HHMM format
+  #
+  #  @return Minutes since midnight
+  #
+  #  @exception ValueError Raised if the time is invalid
+  @staticmethod
+  def hm_to_min(hm):
+    h,m = divmod(int(hm), 100)
+    if h > 23 or m > 59:
+      raise ValueError('invalid time: %s' % hm)
+    return h*60 + m
+
+
+  ## Gets the value active at a given minute of the day.
+  #
+  #  @param minute Minutes since midnight
+  #
+  #  @return The value of the active entry, or None
+  def lookup(self, minute):
+    return self.values[ bisect.bisect_right(self.starts, minute)-1 ]
+
+
+  ## Minutes until the next change of value.
+  #
+  #  @param minute Minutes since midnight
+  #
+  #  @return Minutes until the next transition, or None if the value never changes
+  def next_change(self, minute):
+    if len(self.starts) == 1:
+      return None
+    idx = bisect.bisect_right(self.starts, minute)
+    if idx < len(self.starts):
+      return self.starts[idx] - minute
+    # Last segment continues after midnight if it has the same value as the first one
+    nxt = self.day_min
+    if self.values[-1] == self.values[0]:
+      nxt = nxt + self.starts[1]
+    return nxt - minute
+
+
+  ## Number of segments in the table.
+  def __len__(self):
+    return len(self.starts)
+
+
+## @class WeekTable
+#  Weekly, date-aware heating program compiled into a week-long table of transitions.
+#
+#  Programs entries may be restricted to some days of the week. An entry starting on a given day
+#  and wrapping around midnight continues on the following day. Holidays are date ranges where
+#  programs are replaced by a fixed value, and they take precedence over program entries.
+#
+#  The table covers one week starting at a given minute (minutes since the epoch, UTC). Every
+#  minute of the week is mapped to its segment, so that the value and the next transition are found
+#  in constant time, regardless of the number of entries and holidays.
+class WeekTable(object):
+
+  ## Minutes in a week
+  week_min = 7*ProgramTable.day_min
+
+  ## Constructor.
+  #
+  #  @param entries   List of `(begin, end, value, days)` tuples, with `begin` and `end` in HHMM
+  #                   format, and `days` a list of weekdays (0 is Monday) or None for every day
+  #  @param holidays  List of `(begin, end, value)` tuples, in minutes since the epoch (UTC), end
+  #                   excluded. Use None as value to turn heating off
+  #  @param start_min Beginning of the week covered by the table, in minutes since the epoch (UTC)
+  #
+  #  @exception TypeError  Raised if `begin` or `end` are not numbers
+  #  @exception ValueError Raised if `begin` or `end` are not valid times
+  def __init__(self, entries, holidays, start_min):
+    ## Beginning of the week covered by the table (minutes since the epoch)
+    self.start_min = start_min
+    day_min = ProgramTable.day_min
+    intervals = []
+    prio = 0
+
+    for beg,end,value in holidays:
+      beg = max(beg-start_min, 0)
+      end = min(end-start_min, self.week_min)
+      if beg < end:
+        intervals.append( (beg, end, prio, value) )
+      prio = prio + 1
+
+    # The epoch started on a Thursday. Entries of the day before the table might continue into it
+    start_wday = (start_min//day_min + 3) % 7
+    for beg,end,value,days in entries:
+      if beg >= 0 and end >= 0:
+        beg = ProgramTable.hm_to_min(beg)
+        end = ProgramTable.hm_to_min(end)
+        if end <= beg:
+          end = end + day_min
+      else:
+        beg,end = 0,day_min
+      for d in range(-1, 7):
+        if days is not None and not (start_wday+d) % 7 in days:
+          continue
+        b = max(d*day_min+beg, 0)
+        e = min(d*day_min+end, self.week_min)
+        if b < e:
+          intervals.append( (b, e, prio, value) )
+      prio = prio + 1
+
+    starts,values = sweep(intervals, self.week_min)
+    ## Value of each segment (None if no entry is active)
+    self.values = values
+    ## End minute of each segment (minutes since the start of the table)
+    self.ends = array('i', starts[1:] + [ self.week_min ])
+    ## Segment index for every minute of the week
+    self.segment = array('H')
+    for idx,start in enumerate(starts):
+      self.segment.extend( array('H', [ idx ]) * (self.ends[idx]-start) )
+
+
+  ## Beginning of the week (Monday, 00:00 UTC) containing a given minute.
+  #
+  #  @param minute Minutes since the epoch (UTC)
+  #
+  #  @return Minutes since the epoch (UTC)
+  @staticmethod
+  def week_start(minute):
+    day = minute // ProgramTable.day_min
+    return (day - (day+3)%7) * ProgramTable.day_min
+
+
+  ## Converts a date to minutes since the epoch.
+  #
+  #  @param date A string with the UTC date in the `YYYY-MM-DD` format
+  #
+  #  @return Minutes since the epoch (UTC) at the beginning of the day
+  #
+  #  @exception ValueError Raised if the date is malformed
+  @staticmethod
+  def date_to_min(date):
+    dt = datetime.datetime.strptime(date, '%Y-%m-%d')
+    return calendar.timegm(dt.utctimetuple()) // 60
+
+
+  ## Checks if a minute is covered by the table.
+  #
+  #  @param minute Minutes since the epoch (UTC)
+  #
+  #  @return True if the minute falls within the week of this table
+  def covers(self, minute):
+    return 0 <= minute-self.start_min < self.week_min
+
+
+  ## Gets the value active at a given minute.
+  #
+  #  @param minute Minutes since the epoch (UTC), must be covered by the table
+  #
+  #  @return The value of the active entry, or None
+  def lookup(self, minute):
+    return self.values[ self.segment[minute-self.start_min] ]
+
+
+  ## Minutes until the next change of value, or until the end of the table.
+  #
+  #  @param minute Minutes since the epoch (UTC), must be covered by the table
+  #
+  #  @return Minutes until the next transition
+  def next_change(self, minute):
+    offset = minute - self.start_min
+    return self.ends[ self.segment[offset] ] - offset
+
+
+  ## Number of segments in the table.
+  def __len__(self):
+    return len(self.values)
@@ -0,0 +1,129 @@
+## @file scheduler.py
+#  Contains a class definition for an event-driven scheduler.
+
+import os, time, heapq, select, errno, threading, logging
+from collections import deque
+
+## @class Scheduler
+#  Event-driven scheduler running timed tasks on the main thread.
+#
+#  Callbacks are executed sequentially on the thread calling `run()`, so they never need locking.
+#  Blocking operations (such as network I/O) are run on separate threads through `run_in_thread()`:
+#  their results are handed back to the main thread by means of a callback.
+#
+#  When there is nothing to do the main thread sleeps in `select()` until the next timer expires or
+#  until a thread writes to a wakeup pipe, so no periodic wakeups occur.
+class Scheduler(object):
+
+  ## Constructor.
+  def __init__(self):
+    ## Heap of timers, each one a list `[ when, seq, func, args ]`. Cancelled timers have no func
+    self._timers = []
+    ## Sequence number, used to keep timers with the same time in order
+    self._seq = 0
+    ## Callbacks to run as soon as possible. Appended from any thread
+    self._ready = deque()
+    ## Wakeup pipe: reading and writing ends
+    self._wakeup_r, self._wakeup_w = os.pipe()
+    ## False when the main loop must terminate
+    self._running = False
+
+
+  ## Schedules a function on the main thread at a given time.
+  #
+  #  @param when Absolute time, as returned by `time.time()`
+  #  @param func Function to call
+  #
+  #  @return A timer handle that can be passed to `cancel()`
+  def call_at(self, when, func, *args):
+    self._seq = self._seq + 1
+    timer = [ when, self._seq, func, args ]
+    heapq.heappush(self._timers, timer)
+    return timer
+
+
+  ## Schedules a function on the main thread after a delay.
+  #
+  #  @param delay Delay in seconds
+  #  @param func  Function to call
+  #
+  #  @return A timer handle that can be passed to `cancel()`
+  def call_later(self, delay, func, *args):
+    return self.call_at(time.time()+delay, func, *args)
+
+
+  ## Cancels a timer. Cancelling an expired or already cancelled timer has no effect.
+  #
+  #  @param timer A timer handle, or None
+  @staticmethod
+  def cancel(timer):
+    if timer is not None:
+      timer[2] = None
+      timer[3] = ()
+
+
+  ## Schedules a function on the main thread as soon as possible. Can be called from any thread.
+  #
+  #  @param func Function to call
+  def call_soon(self, func, *args):
+    self._ready.append((func, args))
+    try:
+      os.write(self._wakeup_w, 'x')
+    except OSError:
+      pass
+
+
+  ## Runs a blocking function on a new thread, then passes its return value to a callback on the
+  #  main thread.
+  #
+  #  @param func     Function to run on a separate thread
+  #  @param callback Function called on the main thread with the return value of `func`
+  def run_in_thread(self, func, callback, *args):
+    def worker():
+      try:
+        rv = func(*args)
+      except Exception as e:
+        logging.error('unhandled exception in %s: %s' % (func.__name__, e))
+        rv = None
+      self.call_soon(callback, rv)
+    th = threading.Thread(target=worker, name=func.__name__)
+    th.daemon = True
+    th.start()
+
+
+  ## Stops the main loop after the current callback.
+  def stop(self):
+    self._running = False
+
+
+  ## Main loop: runs callbacks and expired timers, and sleeps until the next event.
+  def run(self):
+    self._running = True
+    while self._running:
+
+      while self._ready and self._running:
+        func,args = self._ready.popleft()
+        func(*args)
+
+      now = time.time()
+      while self._running and self._timers and self._timers[0][0] <= now:
+        timer = heapq.heappop(self._timers)
+        if timer[2] is not None:
+          timer[2](*timer[3])
+
+      if not self._running:
+        break
+      if self._ready:
+        continue
+
+      timeout = None
+      if self._timers:
+        timeout = max(0, self._timers[0][0]-time.time())
+      try:
+        rd,_,_ = select.select([ self._wakeup_r ], [], [], timeout)
+      except select.error as e:
+        if e.args[0] != errno.EINTR:
+          raise
+        rd = []
+      if rd:
+        os.read(self._wakeup_r, 4096)
@@ -0,0 +1,121 @@
+## @file switchclient.py
+#  Contains a class definition for the client of the switch controller socket.
+
+import socket
+
+## @class SwitchClient
+#  Client of the UNIX socket of the switch controller (rpi_switchctl.py started with `--socket`).
+#
+#  Commands are lines of text: `on`, `off` or `status`. The controller answers every command with
+#  the state of the relay (`on` or `off`) as read back from its pin after applying the command, so
+#  that the caller knows the actual state of the hardware. The connection is kept open between
+#  commands and reestablished once if the controller has closed it.
+class SwitchClient(object):
+
+  ## Constructor.
+  #
+  #  @param path    Path of the socket, or None if not configured
+  #  @param timeout Timeout in seconds for connecting and for every reply
+  def __init__(self, path=None, timeout=2):
+    ## Timeout for connecting and for every reply
+    self.timeout = timeout
+    ## Path of the socket
+    self._path = path
+    ## Connected socket, or None
+    self._sock = None
+    ## Data received and not yet consumed
+    self._buf = ''
+
+
+  ## Path of the socket, or None if not configured.
+  @property
+  def path(self):
+    return self._path
+
+
+  ## Changes the path of the socket. The connection is dropped only if the path changes.
+  #
+  #  @param path Path of the socket, or None
+  @path.setter
+  def path(self, path):
+    if path != self._path:
+      self.close()
+      self._path = path
+
+
+  ## Turns the relay on or off.
+  #
+  #  @param on True to turn the relay on
+  #
+  #  @return True if the relay is on after the command
+  #
+  #  @exception IOError Raised on communication errors (socket.error is a subclass)
+  def set(self, on):
+    return self.request('on' if on else 'off')
+
+
+  ## Reads the state of the relay.
+  #
+  #  @return True if the relay is on
+  #
+  #  @exception IOError Raised on communication errors (socket.error is a subclass)
+  def status(self):
+    return self.request('status')
+
+
+  ## Sends a command and waits for the reply. Commands are idempotent, so a command is sent again
+  #  on a new connection if the current one is broken.
+  #
+  #  @param cmd Command: `on`, `off` or `status`
+  #
+  #  @return True if the relay is on
+  #
+  #  @exception IOError Raised on communication errors, or on invalid replies
+  def request(self, cmd):
+    for retry in [ False, True ]:
+      try:
+        if self._sock is None:
+          self._connect()
+        self._sock.sendall(cmd + '\n')
+        reply = self._readline()
+        break
+      except socket.error:
+        self.close()
+        if retry:
+          raise
+    if not reply in [ 'on', 'off' ]:
+      raise IOError('unexpected reply from switch controller: %s' % reply)
+    return reply == 'on'
+
+
+  ## Closes the connection, if open.
+  def close(self):
+    if self._sock is not None:
+      self._sock.close()
+    self._sock = None
+    self._buf = ''
+
+
+  ## Connects to the socket.
+  def _connect(self):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(self.timeout)
+    try:
+      sock.connect(self._path)
+    except socket.error:
+      sock.close()
+      raise
+    self._sock = sock
+
+
+  ## Reads a line from the socket.
+  #
+  #  @return The line, without the newline
+  def _readline(self):
+    while not '\n' in self._buf:
+      data = self._sock.recv(256)
+      if not data:
+        raise socket.error('connection closed by switch controller')
+      self._buf = self._buf + data
+    line,self._buf = self._buf.split('\n', 1)
+    return line.strip()
@@ -1,14 +1,24 @@
 ## @file timestamp.py
 #  Contains a class definition for timestamp handling.
 
-import calendar, datetime
+import calendar, datetime, time, re
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 ## @class TimeStamp
 #  Time stamp handling in Python for human beings.
 #
-#  Python handles dates like crazy. This class is constructed from a timestamp, holds a naive
-#  datetime and has methods with crystal clear names. Small but sufficient for our purposes.
-class TimeStamp:
+#  Python handles dates like crazy. This class is constructed from a timestamp, holds the number of
+#  microseconds since the epoch (UTC) as an integer and has methods with crystal clear names. Small
+#  but sufficient for our purposes.
+#
+#  Parsing ISO strings, formatting them and subtracting do not go through `datetime` objects, as
+#  they are performed for every message received: a naive `datetime` is only built when requested.
+class TimeStamp(object):
+
+  __slots__ = ('_usec',)
 
   ## Predefined date-time output formats
   format = {
@@ -18,6 +28,15 @@ class TimeStamp:
     'ISO_FULL': '%Y-%m-%dT%H:%M:%S.%fZ'
   }
 
+  ## Regular expression matching an ISO-formatted UTC date, with 1 to 6 digits for the fraction
+  iso_re = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)\.(\d{1,6})Z\Z')
+
+  ## Days in each month (non-leap years)
+  month_days = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+  ## The epoch, as a naive `datetime`
+  epoch = datetime.datetime(1970, 1, 1)
+
 
   ## Initializes this `TimeStamp` instance from a UTC time stamp.
   #
@@ -27,9 +46,36 @@ class TimeStamp:
   #  @exception TypeError Raised if parameter is not a number
   def __init__(self, ts_utc=None):
     if ts_utc is None:
-      self._dt_utc = datetime.datetime.utcnow()
-    else:
-      self._dt_utc = datetime.datetime.utcfromtimestamp(ts_utc)
+      ts_utc = time.time()
+    elif not isinstance(ts_utc, (int, long, float)):
+      raise TypeError('timestamp must be a number')
+    self._usec = int(round(ts_utc*1000000))
+
+
+  ## Initializes a `TimeStamp` from the number of microseconds since the epoch (UTC).
+  #
+  #  @param usec An integer with microseconds since the epoch
+  @classmethod
+  def from_usec(cls, usec):
+    ts = cls.__new__(cls)
+    ts._usec = usec
+    return ts
+
+
+  ## Days since the epoch of a given date.
+  #
+  #  Uses the [days from civil](http://howardhinnant.github.io/date_algorithms.html) algorithm.
+  #
+  #  @return Number of days since 1970-01-01
+  @staticmethod
+  def days_from_civil(y, m, d):
+    if m <= 2:
+      y = y - 1
+    era = y // 400
+    yoe = y - era*400
+    doy = (153*(m + (m > 2 and -3 or 9)) + 2)//5 + d - 1
+    doe = yoe*365 + yoe//4 - yoe//100 + doy
+    return era*146097 + doe - 719468
 
 
   ## Initializes this `TimeStamp` from an ISO-formatted UTC date.
@@ -51,19 +97,85 @@ class TimeStamp:
   #
   #  @param isodate A string with the ISO-formatted date in the UTC timezone
   #
+  #  The fraction of seconds may have from 1 to 6 digits: JavaScript uses 3.
+  #
   #  @exception ValueError Raised if string is malformed (not ISO-formatted UTC)
   #  @exception TypeError  Raised if parameter is not a string
   @classmethod
   def from_iso_str(cls, isodate):
-    iso_to_dt = datetime.datetime.strptime(isodate, TimeStamp.format['ISO_FULL'])
-    return cls( calendar.timegm( iso_to_dt.utctimetuple() ) + iso_to_dt.microsecond * 0.000001 )
+    m = cls.iso_re.match(isodate)
+    if m is None:
+      raise ValueError('time data %r does not match format %r' % (isodate, cls.format['ISO_FULL']))
+    y,mo,d,h,mi,s,frac = m.groups()
+    y,mo,d,h,mi,s = int(y),int(mo),int(d),int(h),int(mi),int(s)
+    if mo < 1 or mo > 12 or d < 1 or h > 23 or mi > 59 or s > 59 or \
+       d > cls.month_days[mo-1] + (mo == 2 and calendar.isleap(y) and 1 or 0):
+      raise ValueError('invalid date in %r' % isodate)
+    ts = cls.__new__(cls)
+    ts._usec = ((cls.days_from_civil(y, mo, d)*86400 + h*3600 + mi*60 + s) * 1000000 +
+                int(frac) * 10**(6-len(frac)))
+    return ts
+
+
+  ## Parses many ISO-formatted UTC dates at once.
+  #
+  #  When [NumPy](http://www.numpy.org/) is available, all strings are converted in a single
+  #  vectorized call and an `int64` array is returned. Otherwise, strings are parsed one by one with
+  #  `from_iso_str()` and a list is returned.
+  #
+  #  @param isodates A list of strings with ISO-formatted dates in the UTC timezone
+  #
+  #  @return An array (or list) with microseconds since the epoch for every date
+  #
+  #  @exception ValueError Raised if any string is malformed (not ISO-formatted UTC)
+  #  @exception TypeError  Raised if any element is not a string
+  @classmethod
+  def from_iso_str_batch(cls, isodates):
+    if numpy is None:
+      return [ cls.from_iso_str(d).usec for d in isodates ]
+    if not isodates:
+      return numpy.zeros(0, dtype=numpy.int64)
+    if [ d for d in isodates if not isinstance(d, basestring) ]:
+      raise TypeError('dates must be strings')
+    # numpy is more permissive (offsets, extra digits): check the format, then drop the timezone
+    match = cls.iso_re.match
+    if [ d for d in isodates if match(d) is None ]:
+      raise ValueError('dates do not match format %r' % cls.format['ISO_FULL'])
+    arr = numpy.array(isodates, dtype=str)
+    usec = numpy.char.rstrip(arr, 'Z').astype('datetime64[us]').astype(numpy.int64)
+    if (usec == numpy.datetime64('NaT').astype(numpy.int64)).any():
+      raise ValueError('dates do not match format %r' % cls.format['ISO_FULL'])
+    return usec
+
+
+  ## Finds the first timestamp older than a limit.
+  #
+  #  @param usecs Array or list of microseconds since the epoch, as returned by
+  #               `from_iso_str_batch()`
+  #  @param limit Microseconds since the epoch
+  #
+  #  @return Index of the first element strictly older than `limit`, or None
+  @staticmethod
+  def find_older(usecs, limit):
+    if numpy is not None and isinstance(usecs, numpy.ndarray):
+      older = numpy.flatnonzero(usecs < limit)
+      return int(older[0]) if older.size else None
+    return next(( i for i,u in enumerate(usecs) if u < limit ), None)
 
 
   ## Gets current timestamp, including microseconds, in UTC.
   #
   #  @return A `Float` with the current timestamp in UTC
   def get_timestamp_usec_utc(self):
-    return calendar.timegm( self._dt_utc.utctimetuple() ) + self._dt_utc.microsecond * 0.000001
+    return self._usec / 1000000.
+
+
+  ## Gets the number of microseconds since the epoch (UTC).
+  #
+  #  @return An integer with microseconds since the epoch
+  @property
+  def usec(self):
+    return self._usec
 
 
   ## Gets a naive `datetime` object with this date in UTC.
@@ -73,7 +185,7 @@ class TimeStamp:
   #
   #  @return A naive `datetime` object
   def get_datetime_naive_utc(self):
-    return self._dt_utc
+    return TimeStamp.epoch + datetime.timedelta(microseconds=self._usec)
 
 
   ## Gets a string with a formatted date. See
@@ -84,7 +196,7 @@ class TimeStamp:
   #
   #  @return A customly formatted string representation of the current instance
   def get_formatted_str(self, format):
-    return self._dt_utc.strftime(format)
+    return self.get_datetime_naive_utc().strftime(format)
 
 
   ## ISO-formatted UTC string representation of the date.
@@ -93,7 +205,9 @@ class TimeStamp:
   #
   #  @see from_iso_str
   def __str__(self):
-    return self.get_formatted_str(TimeStamp.format['ISO_FULL'])
+    sec,usec = divmod(self._usec, 1000000)
+    tm = time.gmtime(sec)
+    return '%04d-%02d-%02dT%02d:%02d:%02d.%06dZ' % (tm[0], tm[1], tm[2], tm[3], tm[4], tm[5], usec)
 
 
   ## Subtracts two `TimeStamp` objects.
@@ -104,7 +218,7 @@ class TimeStamp:
   #
   #  @return A `timedelta` object.
   def __sub__(self, other):
-    return datetime.timedelta(seconds=self.get_timestamp_usec_utc()-other.get_timestamp_usec_utc())
+    return datetime.timedelta(microseconds=self._usec-other._usec)
 
 
   ## Check if functionalities provided by this class work.
@@ -137,6 +251,22 @@ class TimeStamp:
         '%s: UTC strings without usec mismatch: %s != %s' % (s, tsnou)
       print '%s: strings without usec test OK' % label
 
+    # batch parsing must agree with parsing one by one
+    good = [ tsstr, '2014-07-30T21:06:15.6Z', '2016-02-29T23:59:59.999999Z' ]
+    assert list(TimeStamp.from_iso_str_batch(good)) == \
+           [ TimeStamp.from_iso_str(d).usec for d in good ], 'Batch: valid dates mismatch'
+    for bad in [ '2014-07-30T21:06:15.1234567Z', '2014-07-30T21:06:15.600+01Z',
+                 '2014-07-30T21:06:15Z', '2014-07-30 21:06:15.600000Z',
+                 '2014-07-30T21:06:15.600000', '2015-02-29T21:06:15.600000Z',
+                 '2014-07-30T24:06:15.600000Z' ]:
+      for parse in [ TimeStamp.from_iso_str, lambda d: TimeStamp.from_iso_str_batch([ tsstr, d ]) ]:
+        try:
+          parse(bad)
+          assert False, 'Invalid date accepted: %s' % bad
+        except ValueError:
+          pass
+    print 'Batch: parsing test OK'
+
     print 'All tests OK'
 
 
@@ -0,0 +1,110 @@
+## @file transport.py
+#  Contains a class definition for HTTP communications with dweet.io.
+
+import time, threading
+import requests
+
+## @class DweetTransport
+#  Connection-pooled HTTP transport for all dweet.io traffic.
+#
+#  A single [requests](http://docs.python-requests.org/en/latest/) session is shared by all calls,
+#  so that TCP and TLS connections are kept alive and reused instead of being established on every
+#  request. All requests use the same timeout. Latency is recorded per endpoint, where an endpoint
+#  is an arbitrary label chosen by the caller. Requests can be performed from several threads.
+class DweetTransport(object):
+
+  ## Constructor.
+  #
+  #  @param base_url  Base URL of the service
+  #  @param pool_size Maximum number of connections kept alive
+  #  @param timeout   Timeout in seconds, or (connect timeout, read timeout)
+  def __init__(self, base_url='https://dweet.io', pool_size=2, timeout=(15,15)):
+    ## Base URL of the service
+    self.base_url = base_url
+    ## Timeout used for all requests
+    self.timeout = timeout
+    ## Latency stats per endpoint: [ requests, errors, total seconds, max seconds ]
+    self.stats = {}
+    ## Lock serializing updates and reads of stats
+    self._stats_lock = threading.Lock()
+    ## Shared HTTP session
+    self._session = requests.Session()
+    ## Current size of the connection pool
+    self._pool_size = None
+    self.set_pool_size(pool_size)
+
+
+  ## Changes the connection pool size. Open connections are dropped only if the size changes.
+  #
+  #  @param pool_size Maximum number of connections kept alive
+  def set_pool_size(self, pool_size):
+    if pool_size == self._pool_size:
+      return
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    self._session.mount('https://', adapter)
+    self._session.mount('http://', adapter)
+    self._pool_size = pool_size
+
+
+  ## Performs a GET request.
+  #
+  #  @param endpoint Label used for latency stats
+  #  @param path     Path, relative to the base URL
+  #
+  #  @return A `requests.Response` object
+  #
+  #  @exception requests.exceptions.RequestException Raised on connection errors
+  def get(self, endpoint, path, **kwargs):
+    return self.request('GET', endpoint, path, **kwargs)
+
+
+  ## Performs a POST request.
+  #
+  #  @param endpoint Label used for latency stats
+  #  @param path     Path, relative to the base URL
+  #
+  #  @return A `requests.Response` object
+  #
+  #  @exception requests.exceptions.RequestException Raised on connection errors
+  def post(self, endpoint, path, **kwargs):
+    return self.request('POST', endpoint, path, **kwargs)
+
+
+  ## Performs a request with the configured timeout, and records its latency.
+  #
+  #  @param method   HTTP method
+  #  @param endpoint Label used for latency stats
+  #  @param path     Path, relative to the base URL
+  #
+  #  @return A `requests.Response` object
+  #
+  #  @exception requests.exceptions.RequestException Raised on connection errors
+  def request(self, method, endpoint, path, **kwargs):
+    t0 = time.time()
+    error = True
+    try:
+      r = self._session.request(method, self.base_url+path, timeout=self.timeout, **kwargs)
+      error = r.status_code != 200
+      return r
+    finally:
+      dt = time.time() - t0
+      with self._stats_lock:
+        st = self.stats.setdefault(endpoint, [0, 0, 0., 0.])
+        st[0] = st[0] + 1
+        st[1] = st[1] + int(error)
+        st[2] = st[2] + dt
+        st[3] = max(st[3], dt)
+
+
+  ## Closes all pooled connections.
+  def close(self):
+    self._session.close()
+
+
+  ## String with latency stats for every endpoint.
+  def __str__(self):
+    with self._stats_lock:
+      stats = sorted([ (ep, list(st)) for ep,st in self.stats.items() ])
+    return ', '.join([ '%s: %d requests, %d errors, avg %.0f ms, max %.0f ms' %
+                       (ep, st[0], st[1], st[2]/st[0]*1000, st[3]*1000)
+                       for ep,st in stats if st[0] > 0 ]) or 'no requests'
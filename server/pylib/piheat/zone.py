@@ -0,0 +1,988 @@
+# -*- coding: utf-8 -*-
+
+## @file zone.py
+#  Contains a class definition for heating zones.
+
+import logging, json, base64, requests
+from Crypto.Hash import SHA256
+from Crypto.Cipher import AES
+from Crypto import Random
+from timestamp import TimeStamp
+from lrucache import LRUCache
+from switchclient import SwitchClient
+from scheduler import Scheduler
+from program import ProgramTable, WeekTable
+
+## @class Zone
+#  Heating zone: a thing with its own programs, sensors, hysteresis and switch.
+#
+#  Commands are received and status updates are sent through the thing on dweet.io, the temperature
+#  is read from the sensors thing, and the switch is turned on and off according to programs and
+#  overrides. The connection pool, the nonce ledger and the main loop belong to the daemon, and are
+#  shared by all of its zones: saving the configuration from a zone saves the whole daemon
+#  configuration.
+class Zone(object):
+
+  ## Settings of the top level zone inherited by additional zones, unless they override them
+  zone_inherited_keys = [ 'msg_expiry_s', 'cmd_expiry_s', 'send_status_every_s', 'password',
+                          'hysteresis_temp_pos', 'hysteresis_temp_neg' ]
+
+  ## Constructor.
+  #
+  #  @param daemon Daemon this zone belongs to (the daemon itself for the top level zone)
+  def __init__(self, daemon):
+    ## Daemon this zone belongs to
+    self._daemon = daemon
+    ## Settings explicitly given for this zone, as opposed to inherited or default ones
+    self._conf_keys = set()
+    ## Thing identifier, as used on dweet.io
+    self._thingid = None
+    ## Thing identifier of the temperature sensors, as used on dweet.io
+    self._sensors_thingid = None
+    ## Friendly name of the thing
+    self._thingname = None
+    ## Messages expiration threshold: not used by server, only sent to client for config
+    self._msg_expiry_s = None
+    ## Commands expiration threshold: honored while retrieving commands
+    self._cmd_expiry_s = None
+    ## Send heating status timeout
+    self._send_status_every_s = None
+    ## Current heating status (boolean)
+    self._heating_status = False
+    ## Current actual heating status (boolean)
+    self._actual_heating_on = False
+    ## Heating ascending/descending (boolean)
+    self._heating_ascending = True
+    ## True if current heating status has been just updated
+    self._heating_status_updated = False
+    ## SHA256 hash of encryption password
+    self._password_hash = None
+    ## Cleartext password
+    self._password = None
+    ## Tolerance (in msec) between message's declared timestamp and server's timestamp
+    self._tolerance_ms = 30000
+    ## Control file for the heating switch (we write 0 or 1 to this file)
+    self._switch_file = None
+    ## Client of the switch controller socket: when its path is set, it is used instead of the
+    ## control file, and the actual heating status is the one confirmed by the controller
+    self._switch = SwitchClient()
+    ## Turn on/turn off programs
+    self._program = []
+    ## Override current program
+    self._override_program = None
+    ## Holidays: date ranges where programs are replaced by a fixed temperature, or turned off
+    self._holidays = []
+    ## Program entries, as `(begin, end, temp, days)` tuples
+    self._program_entries = []
+    ## Holidays, as `(begin, end, temp)` tuples in minutes since the epoch
+    self._holiday_spans = []
+    ## Compiled week-long program table (temperature by minute), covering the current week
+    self._week_table = None
+    ## Compiled override table for daily overrides (HHMM format), or None
+    self._override_table = None
+    ## Override beginning and end (seconds since the epoch) for overrides with ISO dates, or None
+    self._override_span = None
+    ## Never touched heating status?
+    self._actual_heating_firsttime = True
+    ## Last command unique ID (string)
+    self._lastcmd_id = 'saved_configuration'
+    ## Current temperature (Celsius degrees)
+    self._temp = None
+    ## Tolerance (in ms) for trustable temperature. Older temperatures are ignored
+    self._temp_tolerance_ms = 5*60*1000
+    ## Current target temperature (Celsius degrees)
+    self._target_temp = 0;
+    ## Hysteresis positive tolerance
+    self._hysteresis_temp_pos = 0.2
+    ## Hysteresis negative tolerance
+    self._hysteresis_temp_neg = 0.1
+    ## Current humidity (percentage)
+    self._humi = None
+    ## Number of last consecutive errors in reading sensor data
+    self._sensors_errors = 0
+    ## Threshold of consecutive sensor errors before resetting data to None
+    ## (as opposed to keeping the last value)
+    self._sensors_errors_tolerance = 5
+    ## Ledger of already processed nonces, shared by all zones of the daemon
+    self._nonces = daemon._nonces
+    ## Cache of decrypted messages, keyed by nonce and payload digest
+    self._decrypt_cache = LRUCache(256)
+    ## True until a page of dweets has been scanned successfully
+    self._first_scan = True
+    ## Connection-pooled transport for all dweet.io traffic, shared by all zones of the daemon
+    self._dweet = daemon._dweet
+    ## Timer of the next periodic status update
+    self._status_timer = None
+    ## True while a status update is being sent
+    self._status_pending = False
+    ## True if another status update is due as soon as the pending one is sent
+    self._status_again = False
+
+
+  ## Sets the configuration of this zone.
+  #
+  #  @param jsconf    Dictionary with the settings of the zone
+  #  @param inherited Dictionary with the settings inherited from the top level zone, or None. Used
+  #                   where `jsconf` does not override them
+  #
+  #  @exception KeyError   Raised if mandatory settings are missing
+  #  @exception TypeError  Raised if settings are malformed
+  #  @exception ValueError Raised if settings are invalid
+  def set_zone_conf(self, jsconf, inherited=None):
+    self._conf_keys = set(jsconf.keys())
+    jsconf = dict((inherited or {}).items() + jsconf.items())
+    self._msg_expiry_s = int( jsconf['msg_expiry_s'] )
+    self._cmd_expiry_s = int( jsconf['cmd_expiry_s'] )
+    self._thingid = str( jsconf['thingid'] )
+    self._thingname = str( jsconf['thingname'] )
+    self._sensors_thingid = str( jsconf.get('sensors_thingid', self._thingid+'-sensors') )
+    self._send_status_every_s = int( jsconf['send_status_every_s'] )
+    self._switch_file = str( jsconf['switch_file'] )
+    self._switch.path = jsconf.get('switch_socket', None)
+    self._hysteresis_temp_pos = float( jsconf.get('hysteresis_temp_pos',
+                                                  self._hysteresis_temp_pos) )
+    self._hysteresis_temp_neg = float( jsconf.get('hysteresis_temp_neg',
+                                                  self._hysteresis_temp_neg) )
+    self.set_programs( jsconf.get('program', []), jsconf.get('override_program', None),
+                       jsconf.get('holidays', []) )
+    self._password = str(jsconf['password'])
+    hashfunc = SHA256.new()
+    hashfunc.update( self._password )
+    if hashfunc.digest() != self._password_hash:
+      self._decrypt_cache.clear()
+    self._password_hash = hashfunc.digest()
+
+
+  ## Configuration of this zone. Inherited and default settings are left out, unless they were
+  #  given explicitly, so that they keep following the top level zone and the defaults.
+  #
+  #  @return A dictionary with the settings of the zone, as read by `set_zone_conf()`
+  def zone_conf(self):
+    jsconf = {
+      'msg_expiry_s': self._msg_expiry_s,
+      'cmd_expiry_s': self._cmd_expiry_s,
+      'thingid': self._thingid,
+      'thingname': self._thingname,
+      'sensors_thingid': self._sensors_thingid,
+      'send_status_every_s': self._send_status_every_s,
+      'switch_file': self._switch_file,
+      'switch_socket': self._switch.path,
+      'hysteresis_temp_pos': self._hysteresis_temp_pos,
+      'hysteresis_temp_neg': self._hysteresis_temp_neg,
+      'program': self._program,
+      'override_program': self._override_program,
+      'holidays': self._holidays,
+      'password': self._password
+    }
+    inherited = self.zone_inherited_keys + ['sensors_thingid']
+    return dict([ (k,v) for k,v in jsconf.items() if k in self._conf_keys or not k in inherited ])
+
+
+  ## Saves the configuration of the daemon, including all its zones.
+  #
+  #  @return True on success
+  def save_conf(self):
+    return self._daemon.save_conf()
+
+
+  ## Gets status of heating.
+  @property
+  def heating_status(self):
+    return self._heating_status
+
+
+  ## Sets status of heating.
+  #
+  #  @param status True for on, False for off
+  @heating_status.setter
+  def heating_status(self, status):
+    if self._heating_status != status:
+      self._heating_status = status
+      self._heating_status_updated = True
+    self.update_temp_status()
+
+
+  ## Gets temperature.
+  @property
+  def temp(self):
+    return self._temp
+
+
+  ## Sets temperature.
+  #
+  #  @param temp The temperature to set
+  @temp.setter
+  def temp(self, temp):
+    if self._temp != temp:
+      self._temp = temp
+      self._heating_status_updated = True
+    self.update_temp_status()
+
+
+  ## Gets target temperature.
+  @property
+  def target_temp(self):
+    return self._target_temp
+
+
+  ## Sets target temperature.
+  #
+  #  @param target_temp The target temperature to set
+  @target_temp.setter
+  def target_temp(self, target_temp):
+    if self._target_temp != target_temp:
+      self._target_temp = target_temp
+      self._heating_status_updated = True
+    self.update_temp_status()
+
+
+  ## Gets actual heating status.
+  @property
+  def actual_heating_on(self):
+    return self._actual_heating_on
+
+
+  ## Sets actual heating on or off.
+  #
+  #  @param status True if on, False if off
+  @actual_heating_on.setter
+  def actual_heating_on(self, status):
+    if status == self._actual_heating_on and not self._actual_heating_firsttime:
+      logging.debug("actual heating status unchanged (%s)" %
+                    (self._actual_heating_on and "on" or "off"))
+      return True
+    self._actual_heating_firsttime = False
+    # We change the status.
+    if status:
+      status_str = "on"
+      status_file = "1"
+    else:
+      status_str = "off"
+      status_file = "0"
+    logging.info("turning actual heating %s" % status_str)
+    if self._switch.path is not None:
+      # Member reflects the state confirmed by the switch controller
+      try:
+        confirmed = self._switch.set(status)
+      except IOError as e:
+        logging.error("cannot change status: %s" % e)
+        return False
+      if confirmed != self._actual_heating_on:
+        self._actual_heating_on = confirmed
+        self._heating_status_updated = True
+      if confirmed != status:
+        logging.error("cannot change status: switch is still %s" % (confirmed and "on" or "off"))
+        return False
+      return True
+    try:
+      with open(self._switch_file, "w") as fp:
+        fp.write(status_file)
+    except IOError as e:
+      logging.error("cannot change status: %s" % e)
+      return False
+    # Set member only if write is successful.
+    self._actual_heating_on = status
+    self._heating_status_updated = True
+    return True
+
+
+  ## Updates status and temperature, and possibly changes actual status
+  #  accordingly.
+  def update_temp_status(self):
+    status = self._heating_status
+    temp = self._temp
+    target_temp = self._target_temp
+    logging.debug("updating temp (%s), target temp (%f) and status (%s)" %
+                  (str(temp), target_temp, status))
+
+    if status:
+      # Heating set to be on. Check temp. Treats temp is None case.
+      if temp is None or temp <= self.target_temp-self._hysteresis_temp_neg:
+        self.actual_heating_on = True
+        self._heating_ascending = True
+      elif temp >= self.target_temp+self._hysteresis_temp_pos:
+        self.actual_heating_on = False
+        self._heating_ascending = False
+      else:
+        # Between hysteresis boundaries. Heating on if ascending, off if
+        # descending. So, heating has same status of ascending.
+        self.actual_heating_on = self._heating_ascending
+      logging.debug("hysteresis: %s" %
+                    (self._heating_ascending and "ascending" or "descending"))
+    else:
+      # Heating should be off. Ascending for the next time it goes on.
+      self.actual_heating_on = False
+      self._heating_ascending = True
+
+
+  ## Returns True if heating status was just updated, and immediately set the
+  #  value to false.
+  #
+  #  @return True if heating status was just updated, false after first call
+  @property
+  def heating_status_updated(self):
+    x = self._heating_status_updated
+    self._heating_status_updated = False
+    return x
+
+
+  ## Parses a page of dweets into a compact list of messages.
+  #
+  #  The page is walked only once. Malformed dweets are kept as `None` to preserve ordering. Along
+  #  with the list, an index counting how many times each nonce appears in the page is returned.
+  #
+  #  @param items List of dweets, as found in the `with` field of the dweet.io response
+  #
+  #  @return A tuple with the list of `(created, content, nonce)` tuples and the nonce count index
+  @staticmethod
+  def parse_dweets(items):
+    msgs = []
+    nonce_count = {}
+    for item in items:
+      try:
+        content = item['content']
+        nonce = content.get('nonce', None)
+        msgs.append( (item['created'], content, nonce) )
+      except (KeyError, TypeError, AttributeError):
+        msgs.append(None)
+        continue
+      if nonce is not None:
+        nonce_count[nonce] = nonce_count.get(nonce, 0) + 1
+    return msgs, nonce_count
+
+
+  ## Get latest command via dweet.io.
+  #
+  #  @return True on success, False if it fails
+  def get_latest_command(self):
+    items = self.fetch_commands()
+    if items is None:
+      return False
+    return self.process_dweets(items)
+
+
+  ## Fetches the latest dweets from dweet.io. Network only: can be run on any thread.
+  #
+  #  @return The list of dweets, or None if it fails
+  def fetch_commands(self):
+
+    logging.debug('checking for commands')
+
+    try:
+      r = self._dweet.get('get_dweets', '/get/dweets/for/%s' % self._thingid)
+    except requests.exceptions.RequestException as e:
+      logging.error('failed to get latest commands: %s' % e)
+      return None
+
+    if r.status_code != 200:
+      logging.error('invalid status code received: %d' % r.status_code)
+      return None
+
+    try:
+      return r.json()['with']
+    except Exception as e:
+      logging.error('error parsing response: %s' % e)
+      return None
+
+
+  ## Parses creation dates of a page of dweets at once, and counts how many recent dweets there
+  #  are before the first one older than the commands expiration threshold.
+  #
+  #  @param msgs   List of messages, as returned by `parse_dweets()`
+  #  @param now_us Current time (usec)
+  #
+  #  @return A tuple with the list of creation dates (usec, None where malformed) aligned with
+  #          `msgs`, and the number of leading recent messages
+  def recent_dweets(self, msgs, now_us):
+    idx = [ i for i,m in enumerate(msgs) if m is not None ]
+    try:
+      parsed = TimeStamp.from_iso_str_batch([ msgs[i][0] for i in idx ])
+      outdated = TimeStamp.find_older(parsed, now_us-self._cmd_expiry_s*1000000)
+      parsed = list(parsed)
+    except (ValueError, TypeError):
+      # at least one malformed date: parse them one by one
+      parsed = []
+      for i in idx:
+        try:
+          parsed.append(TimeStamp.from_iso_str(msgs[i][0]).usec)
+        except (ValueError, TypeError):
+          parsed.append(None)
+      limit = now_us - self._cmd_expiry_s*1000000
+      outdated = next(( k for k,u in enumerate(parsed) if u is not None and u < limit ), None)
+    created_us = [ None ] * len(msgs)
+    for i,u in zip(idx, parsed):
+      created_us[i] = u
+    return created_us, len(msgs) if outdated is None else idx[outdated]
+
+
+  ## Looks for the most recent valid command in a page of dweets and applies it.
+  #
+  #  Dweets are expected newest first. A nonce is unique if it does not appear again in any older
+  #  dweet of the same page: the nonce count index is decremented as dweets are visited, so the
+  #  check is performed in constant time.
+  #
+  #  @param items List of dweets, as found in the `with` field of the dweet.io response
+  #
+  #  @return True on success, False if the page could not be parsed
+  def process_dweets(self, items):
+
+    skipped = 0
+
+    try:
+
+      msgs, nonce_count = self.parse_dweets(items)
+      now_ts = TimeStamp()
+      self._nonces.evict(now_ts.usec)
+
+      # messages are valid only if recent enough: no need to parse the rest
+      created_us, n_recent = self.recent_dweets(msgs, now_ts.usec)
+      if n_recent < len(msgs):
+        logging.debug('%d outdated messages skipped' % (len(msgs)-n_recent))
+
+      for m,msg_us in zip(msgs[:n_recent], created_us[:n_recent]):
+
+        # nonce of the decrypted message, if not recorded yet
+        consumed = None
+
+        try:
+
+          if m is None:
+            raise KeyError('content')
+          if msg_us is None:
+            raise TypeError('invalid creation date')
+          created, content, nonce = m
+          msg_ts = TimeStamp.from_usec(msg_us)
+
+          # nonce must be unique
+          if nonce is None:
+            raise KeyError('nonce')
+          nonce_count[nonce] = nonce_count[nonce] - 1
+          nonce_is_unique = nonce_count[nonce] == 0
+
+          # nonce must not have been processed already: if it was, but by this very message (same
+          # expiry), all older messages have been processed as well. Only messages decrypted and
+          # processed are recorded. On the first scan, messages processed before a restart are
+          # processed again, so that the latest command is found
+          msg_expiry = msg_ts.usec + self._cmd_expiry_s*1000000
+          seen_expiry = self._nonces.get(nonce)
+          recorded = seen_expiry == msg_expiry
+          if recorded and self._first_scan:
+            seen_expiry = None
+
+          if nonce_is_unique and seen_expiry is None:
+            msg = self.decrypt_msg(content)
+            if msg is not None and not recorded:
+              consumed = nonce
+
+          if not nonce_is_unique:
+            logging.warning('duplicated nonce (%s): possible replay attack, ignoring' % nonce)
+
+          elif seen_expiry == msg_expiry:
+            logging.debug('found already processed message, skipping the rest')
+            break
+
+          elif seen_expiry is not None:
+            logging.warning('nonce already used (%s): possible replay attack, ignoring' % nonce)
+
+          elif msg is None:
+            logging.warning('cannot decrypt message, check password')
+            continue
+
+          else:
+
+            msg_real_ts = TimeStamp.from_iso_str( msg['timestamp'] )
+
+            if abs(msg_ts.usec-msg_real_ts.usec) > self._tolerance_ms*1000:
+              logging.warning('message timestamps mismatch, ignoring')
+
+            elif msg['type'].lower() != 'command':
+              if not recorded:
+                self._nonces.add(nonce, msg_expiry)
+
+            else:
+
+              logging.debug('found valid command')
+              logging.debug(json.dumps(msg, indent=2))
+
+              save = False
+              if msg['override_program'] != self._override_program:
+                save = True
+              if msg['program'] != self._program:
+                save = True
+              holidays = msg.get('holidays', self._holidays)
+              if holidays != self._holidays:
+                save = True
+              lid = msg['id']
+
+              self.set_programs(msg['program'], msg['override_program'], holidays)
+              self._lastcmd_id = lid
+              if not recorded:
+                self._nonces.add(nonce, msg_expiry)
+
+              if save:
+                if self.save_conf():
+                  logging.info('new configuration saved')
+                else:
+                  logging.error('cannot save new configuration')
+
+              break
+
+        except (KeyError, TypeError, ValueError) as e:
+          skipped = skipped+1
+          if consumed is None:
+            logging.debug('error parsing, skipped: %s' % e)
+          else:
+            # decrypted messages that cannot be processed never will: they are not tried again
+            logging.warning('invalid message, skipped: %s' % e)
+            self._nonces.add(consumed, msg_expiry)
+
+    except Exception as e:
+      logging.error('error parsing response: %s' % e)
+      return False
+
+    self._first_scan = False
+    if skipped > 0:
+      logging.warning('invalid messages skipped: %d' % skipped)
+    logging.debug('decryption cache: %s' % self._decrypt_cache)
+    return True
+
+
+  ## Sends status update.
+  #
+  #  @return True on success, False if it fails
+  def send_status_update(self):
+    return self.post_status( self.status_payload() )
+
+
+  ## Prepares an encrypted status update from the current status.
+  #
+  #  @return A tuple with the encrypted payload and the heating status ("on" or "off")
+  def status_payload(self):
+
+    if self.heating_status:
+      status_str = 'on'
+    else:
+      status_str = 'off'
+    logging.debug('sending status update (status is %s)' % status_str)
+
+    now = TimeStamp()
+    raw = {
+      'type': 'status',
+      'timestamp': str(now),  # ISO UTC
+      'status': self.heating_status,
+      'temp': self.temp,
+      'msgexp_s': self._msg_expiry_s,
+      'msgupd_s': self._send_status_every_s,
+      'program': self._program,
+      'override_program': self._override_program,
+      'holidays': self._holidays,
+      'name': self._thingname,
+      'lastcmd_id': self._lastcmd_id
+    }
+    if self.heating_status:
+      raw.update({
+        'actual_status': self.actual_heating_on,
+        'target_temp': self.target_temp,
+      })
+    logging.debug('message: ' + json.dumps(raw, indent=2))
+    return self.encrypt_msg(raw), status_str
+
+
+  ## Sends a prepared status update. Network only: can be run on any thread.
+  #
+  #  @param status_payload A tuple as returned by `status_payload()`
+  #
+  #  @return True on success, False if it fails
+  def post_status(self, status_payload):
+
+    payload,status_str = status_payload
+    try:
+      r = self._dweet.post('dweet_status', '/dweet/for/%s' % self._thingid, params=payload)
+    except requests.exceptions.RequestException as e:
+      logging.error('failed to send update: %s' % e)
+      return False
+
+    if r.status_code != 200:
+      logging.error('invalid status code received: %d' % r.status_code)
+      return False
+
+    logging.info('status update sent (status is %s)' % status_str)
+    logging.debug('dweet.io latency: %s' % self._dweet)
+    return True
+
+
+  ## Sends a command to itself.
+  #
+  #  @return True on success, False if it fails
+  def send_command(self):
+    cmd_id,payload = self.command_payload()
+    if not self.post_command(payload):
+      return False
+    self._lastcmd_id = cmd_id
+    return True
+
+
+  ## Prepares an encrypted command with the current program and override.
+  #
+  #  @return A tuple with the command ID and the encrypted payload
+  def command_payload(self):
+    raw = { "type": "command",
+            "id": base64.b64encode(Random.new().read(30)),
+            "timestamp": str(TimeStamp()),
+            "program": self._program,
+            "from": "myself",
+            "override_program": self._override_program,
+            "holidays": self._holidays }
+    logging.debug("sending command: %s" % json.dumps(raw, indent=2))
+    return raw["id"], self.encrypt_msg(raw)
+
+
+  ## Sends a prepared command. Network only: can be run on any thread.
+  #
+  #  @param payload Encrypted command
+  #
+  #  @return True on success, False if it fails
+  def post_command(self, payload):
+    try:
+      r = self._dweet.post("dweet_command", "/dweet/for/%s" % self._thingid, params=payload)
+    except requests.exceptions.RequestException as e:
+      logging.error("failed to send command: %s" % e)
+      return False
+    if r.status_code != 200:
+      logging.error("invalid status code received while sending command: %d" % r.status_code)
+      return False
+    logging.info("command sent")
+    return True
+
+
+  ## Encrypts an object using AES-CBC.
+  #
+  #  @param obj Source object
+  #
+  #  @return The encrypted object, with a `nonce` and a `payload`
+  def encrypt_msg(self, obj):
+
+    # random IV
+    rndfp = Random.new()
+    iv = rndfp.read(16)
+
+    # convert to JSON (output is always ASCII)
+    obj_json = str( json.dumps(obj) )
+
+    # pad to blocks of 16 bytes
+    pad_len = 16 - len(obj_json) % 16
+    obj_json = obj_json + chr(pad_len)*pad_len
+
+    # encrypt
+    aes = AES.new(self._password_hash, AES.MODE_CBC, iv)
+    obj_enc = aes.encrypt(obj_json)
+
+    # convert to base64
+    obj_enc_b64 = base64.b64encode(obj_enc)
+    iv_b64 = base64.b64encode(iv)
+
+    # assemble final object
+    return {
+      'nonce': iv_b64,
+      'payload': obj_enc_b64
+    }
+
+
+  ## Decrypts an object using AES-CBC.
+  #
+  #  Results are cached by nonce and payload digest, so that the same message is decrypted only
+  #  once with the current password. Cached objects are shared: they must not be modified.
+  #
+  #  @param obj Encrypted object (must have a `nonce` and `payload` key)
+  #
+  #  @return The decrypted object
+  def decrypt_msg(self, obj):
+
+    if not 'nonce' in obj or not 'payload' in obj:
+      return None
+
+    hashfunc = SHA256.new()
+    hashfunc.update( obj['payload'] )
+    key = (obj['nonce'], hashfunc.digest())
+    dec = self._decrypt_cache.get(key, LRUCache.missing)
+    if dec is LRUCache.missing:
+      dec = self._decrypt_msg_nocache(obj)
+      self._decrypt_cache.put(key, dec)
+    return dec
+
+
+  ## Decrypts an object using AES-CBC, bypassing the cache.
+  #
+  #  @param obj Encrypted object (must have a `nonce` and `payload` key)
+  #
+  #  @return The decrypted object
+  def _decrypt_msg_nocache(self, obj):
+
+    try:
+      iv = base64.b64decode( obj['nonce'] )
+      enc = base64.b64decode( obj['payload'] )
+    except TypeError as e:
+      logging.debug('cannot decode base64: %s' % e)
+      return None
+
+    # decrypt
+    # note: does not check if password is ok! JSON will fail in case of garbage
+    try:
+      aes = AES.new(self._password_hash, AES.MODE_CBC, iv)
+    except ValueError as e:
+      logging.debug('cannot decrypt: %s' % e)
+      return None
+
+    dec = aes.decrypt(enc)
+
+    # last byte contains how many bytes were used for padding
+    # padding is constituted by the last byte repeated (last byte) times
+    pad_len = ord(dec[-1])
+    dec = dec[0:-pad_len]
+
+    # decode from JSON
+    try:
+      dec = json.loads(dec)
+    except ValueError as e:
+      logging.debug('cannot decode JSON: %s' % e)
+      return None
+
+    return dec
+
+
+  ## True if the given "time" (hours, minutes) is included within the interval.
+  #  If begin < end assumes different days. If begin or end are < 0, assume we
+  #  are always in the interval.
+  #
+  #  @return A boolean
+  @staticmethod
+  def tminc(hm, beg, end):
+    if beg < 0 or end < 0:
+      return True
+    if beg < end:
+      return beg <= hm and hm < end
+    else:
+      return hm >= beg or hm < end
+
+
+  ## Get data from sensor
+  def get_sensors(self):
+    self.apply_sensors( *self.fetch_sensors() )
+
+
+  ## Fetches latest sensor data from dweet.io. Network only: can be run on any thread.
+  #
+  #  @return A tuple with the decoded response (None on error) and the error (None on success)
+  def fetch_sensors(self):
+    logging.debug("getting temperature and other sensor data")
+    try:
+      return self._dweet.get("get_sensors",
+                             "/get/latest/dweet/for/%s" % self._sensors_thingid).json(), None
+    except Exception as e:
+      return None, e
+
+
+  ## Updates temperature and humidity from fetched sensor data.
+  #
+  #  @param val   Decoded sensor data, as returned by `fetch_sensors()`
+  #  @param error Error occurred while fetching sensor data, or None
+  def apply_sensors(self, val, error):
+    try:
+      if error is not None:
+        raise error
+      delta_us = TimeStamp().usec - TimeStamp.from_iso_str(val["with"][0]["created"]).usec
+      if delta_us > self._temp_tolerance_ms*1000:
+        raise Exception("temperature data is too old (> %d ms)" % self._temp_tolerance_ms)
+      self.temp = float(val["with"][0]["content"]["temp"]);
+      self._humi = float(val["with"][0]["content"].get("humi", None));
+      self._sensors_errors = 0
+    except Exception as e:
+      self._sensors_errors = self._sensors_errors + 1
+      if self._sensors_errors >= self._sensors_errors_tolerance:
+        logging.error("too many sensors reading errors (%d out of %d): resetting data: %s" %
+                      (self._sensors_errors, self._sensors_errors_tolerance, e))
+        self.temp = None
+        self._humi = None
+      else:
+        logging.warning("sensor error, retaining old data: %s" % e)
+    logging.debug("sensor data: temp=%s, humidity=%s" %
+                  (self.temp  and "%.1f°C" % self.temp  or "n/a",
+                   self._humi and "%.1f%%" % self._humi or "n/a"))
+
+
+  ## Sets programs, override and holidays, and compiles them into interval tables. Tables are
+  #  compiled before changing anything, so invalid programs leave the current ones untouched.
+  #
+  #  @param program          List of programs
+  #  @param override_program Override, or None
+  #  @param holidays         List of holidays
+  #
+  #  @exception KeyError   Raised if mandatory fields are missing
+  #  @exception TypeError  Raised if programs are malformed
+  #  @exception ValueError Raised if times or dates are invalid
+  def set_programs(self, program, override_program, holidays):
+    entries = []
+    for p in program or []:
+      days = p.get("days", None)
+      if days is not None:
+        days = [ int(d) for d in days ]
+        if [ d for d in days if d < 0 or d > 6 ]:
+          raise ValueError("invalid days: %s" % days)
+      entries.append( (p["begin"], p["end"], p.get("temp", 9999), days) )
+    holiday_spans = [ (WeekTable.date_to_min(h["from"]),
+                       WeekTable.date_to_min(h["to"])+ProgramTable.day_min,
+                       h.get("temp", None)) for h in holidays or [] ]
+    now_min = TimeStamp().usec // 60000000
+    week_table = WeekTable(entries, holiday_spans, WeekTable.week_start(now_min))
+
+    override_table = None
+    override_span = None
+    if override_program:
+      beg = override_program["begin"]
+      end = override_program["end"]
+      if not "status" in override_program:
+        raise KeyError("status")
+      if isinstance(beg, basestring) or isinstance(end, basestring):
+        override_span = ( TimeStamp.from_iso_str(beg).get_timestamp_usec_utc(),
+                          TimeStamp.from_iso_str(end).get_timestamp_usec_utc() )
+      else:
+        override_table = ProgramTable([ (beg, end, True) ])
+
+    self._program = program
+    self._override_program = override_program
+    self._holidays = holidays or []
+    self._program_entries = entries
+    self._holiday_spans = holiday_spans
+    self._week_table = week_table
+    self._override_table = override_table
+    self._override_span = override_span
+    logging.debug("Programs set: %s, override: %s, holidays: %s (%d segments this week)" %
+                  (json.dumps(program), json.dumps(override_program), json.dumps(holidays),
+                   len(week_table)))
+
+
+  ## Gets the compiled program table covering a given minute, compiling it if needed.
+  #
+  #  @param minute Minutes since the epoch (UTC)
+  #
+  #  @return A WeekTable
+  def week_table(self, minute):
+    if not self._week_table.covers(minute):
+      self._week_table = WeekTable(self._program_entries, self._holiday_spans,
+                                   WeekTable.week_start(minute))
+    return self._week_table
+
+
+  ## Evaluates programs and overrides, and changes heating status accordingly.
+  #
+  #  @param now A TimeStamp with the current time, or None
+  #
+  #  @return True if the override has just expired and a command must be sent to notify clients
+  def evaluate_program(self, now=None):
+    if now is None:
+      now = TimeStamp()
+    now_s = now.get_timestamp_usec_utc()
+    now_min = int(now_s//60)
+    dt = now.get_datetime_naive_utc()
+    hm = dt.hour*100 + dt.minute
+    minute = dt.hour*60 + dt.minute
+    expired = False
+
+    if self._override_program:
+      logging.debug("An override is set")
+      if self._override_span is not None:
+        active = self._override_span[0] <= now_s < self._override_span[1]
+        over = now_s >= self._override_span[1]
+      else:
+        # Overrides in HHMM format are < 24 h
+        active = self._override_table.lookup(minute) is not None
+        over = not active and hm > self._override_program["end"]
+      if active:
+        self.heating_status = self._override_program["status"]
+        if self.heating_status:
+          self.target_temp = self._override_program.get("temp", 9999)
+      elif over:
+        logging.debug("Override has expired, deleting")
+        self.set_programs(self._program, None, self._holidays)
+        self.save_conf()
+        expired = True
+    else:
+      logging.debug("No override set")
+
+    if not self._override_program:
+      if self._program or self._holidays:
+        temp = self.week_table(now_min).lookup(now_min)
+        logging.debug("Programs are set: target temperature is %s" % temp)
+        self.heating_status = temp is not None
+        self.target_temp = temp if temp is not None else -9999
+      else:
+        logging.debug("No program set")
+        self.heating_status = False
+
+    return expired
+
+
+  ## Seconds until the next time where programs or override might change heating status.
+  #
+  #  Transitions are looked up in the compiled tables. For daily overrides, the minute after their
+  #  end is also considered, as it is when they expire.
+  #
+  #  @param now A TimeStamp with the current time
+  #
+  #  @return Seconds until the next transition (at most one day)
+  def next_program_change_s(self, now):
+    now_s = now.get_timestamp_usec_utc()
+    now_min = int(now_s//60)
+    sec = now_s - now_min*60
+    minute = now_min % ProgramTable.day_min
+    changes = [ ProgramTable.day_min*60, self.week_table(now_min).next_change(now_min)*60-sec ]
+    if self._override_span is not None:
+      changes.extend([ t-now_s for t in self._override_span if t > now_s ])
+    elif self._override_program:
+      nxt = self._override_table.next_change(minute)
+      if nxt is not None:
+        changes.append(nxt*60-sec)
+      if self._override_program["end"] >= 0:
+        end = ProgramTable.hm_to_min(self._override_program["end"])
+        changes.append(((end+1-minute) % ProgramTable.day_min or ProgramTable.day_min)*60-sec)
+    return min(changes)
+
+
+  ## Scheduler callback: a command has been sent.
+  #
+  #  @param cmd_id ID of the command
+  #  @param ok     True if the command was sent successfully
+  def _task_command_sent(self, cmd_id, ok):
+    if ok:
+      self._lastcmd_id = cmd_id
+
+
+  ## Scheduler task: sends a status update on a separate thread.
+  def _task_status(self):
+    Scheduler.cancel(self._status_timer)
+    self._status_timer = None
+    if self._status_pending:
+      self._status_again = True
+      return
+    self._status_pending = True
+    self._daemon._sched.run_in_thread(self.post_status, self._task_status_done,
+                                      self.status_payload())
+
+
+  ## Scheduler callback: a status update has been sent.
+  #
+  #  @param ok True if the status update was sent successfully
+  def _task_status_done(self, ok):
+    self._status_pending = False
+    if self._status_again or self.heating_status_updated:
+      self._status_again = False
+      self._task_status()
+    else:
+      self._status_timer = self._daemon._sched.call_later(
+        ok and self._send_status_every_s or self._daemon._retry_every_s, self._task_status)
+
+
+  ## Sends a status update right away if heating status has changed.
+  def _status_if_updated(self):
+    if self.heating_status_updated or (self._status_timer is None and not self._status_pending):
+      self._task_status()